@@ -3,8 +3,9 @@ from groq import Groq
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
 from huggingface_hub import login
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from pydantic import BaseModel, field_validator
+from .clients import get_openai_client, get_async_openai_client, get_settings
 
 class MessageInfo(BaseModel):
     tassonomia: list[str]
@@ -71,20 +72,16 @@ class VLLMModel:
     It uses the 'meta-llama/Llama-3.1-8B-Instruct' model and retrieves the API key
     from the 'VLLM_API_KEY' environment variable.
     """
-    def __init__(self):
-        """
-        Initializes the vLLM client.
-        The API key is retrieved from the VLLM_API_KEY environment variable.
-        Ensure this environment variable is set before running the code.
+    def __init__(self, client: OpenAI = None, model_name: str = None):
         """
+        Initializes the vLLM model.
 
-        from start_api import start_api_openai_base_url, start_api_openai_base_model, start_api_openai_key
-        self.client = OpenAI(
-        base_url = start_api_openai_base_url,
-        # base_url = "http://localhost:1234/v1", # local vLLM endpoint
-        api_key=start_api_openai_key, # required, but unused
-        )
-        self.model_name = start_api_openai_base_model
+        Args:
+            client (OpenAI): Client to use; defaults to the shared pooled client of aixparag.clients.
+            model_name (str): Model to call; defaults to the configured base model.
+        """
+        self.client = client if client is not None else get_openai_client()
+        self.model_name = model_name if model_name is not None else get_settings().base_model
 
     def generate(self, sys_prompt: str, conversation: list, max_new_tokens: int = 500, temperature: float = 0.9) -> str:
         if not conversation:
@@ -140,6 +137,75 @@ class VLLMModel:
             print(f"Error during reply generation: {e}")
             return "An error occurred while generating the reply."    
 
+
+
+class AsyncVLLMModel:
+    """
+    Asyncio counterpart of VLLMModel, backed by AsyncOpenAI: awaiting a generation
+    releases the event loop instead of holding a worker thread for the whole call.
+    """
+    def __init__(self, client: AsyncOpenAI = None, model_name: str = None):
+        """
+        Initializes the async vLLM model.
+
+        Args:
+            client (AsyncOpenAI): Client to use; defaults to the shared pooled client of aixparag.clients.
+            model_name (str): Model to call; defaults to the configured base model.
+        """
+        self.client = client if client is not None else get_async_openai_client()
+        self.model_name = model_name if model_name is not None else get_settings().base_model
+
+    async def generate(self, sys_prompt: str, conversation: list, max_new_tokens: int = 500, temperature: float = 0.9) -> str:
+        if not conversation:
+            return "Error: The conversation list cannot be empty."
+
+        messages = [{"role": "system", "content": sys_prompt}]
+        for i, text in enumerate(conversation):
+            role = "user" if i % 2 == 0 else "assistant"
+            messages.append({"role": role, "content": text})
+
+        try:
+            response = await self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            temperature=temperature,
+            max_completion_tokens=max_new_tokens
+            )
+            return response.choices[0].message.content
+
+        except Exception as e:
+            print(f"Error during reply generation: {e}")
+            return "An error occurred while generating the reply."
+
+    async def generate_json(self, sys_prompt: str, conversation: list, max_new_tokens: int = 500, temperature: float = 0.9) -> str:
+        if not conversation:
+            return "Error: The conversation list cannot be empty."
+
+        messages = [{"role": "system", "content": sys_prompt}]
+        for i, text in enumerate(conversation):
+            role = "user" if i % 2 == 0 else "assistant"
+            messages.append({"role": role, "content": text})
+
+        try:
+            response = await self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            temperature=temperature,
+            max_completion_tokens=max_new_tokens,
+            response_format={
+                        'type': 'json_schema',
+                        'json_schema': {
+                            'name' : 'message-info',
+                            'schema' : MessageInfo.model_json_schema()
+                        }
+                    }
+            )
+            return response.choices[0].message.content
+
+        except Exception as e:
+            print(f"Error during reply generation: {e}")
+            return "An error occurred while generating the reply."
+
     
 class HuggingFaceModel:
     """
@@ -1,7 +1,11 @@
-from .LanguageModel import GroqModel, HuggingFaceModel, VLLMModel
+from .LanguageModel import GroqModel, HuggingFaceModel, VLLMModel, AsyncVLLMModel
 from .VectorStoreQdrant import VectorStore
+from .VectorStoreMmap import MmapVectorStore
 from .Retriever import Retriever
-from .data_preparation import extract_metadata
+from .data_preparation import extract_metadata, load_metadata_cache
+from .indexer import build_documents, sync_vector_store
+from .ingestion import DEFAULT_BATCH_SIZE
+from .gazetteer import get_gazetteer
 from langchain_core.documents import Document
 # from . import prompts
 import pandas as pd
@@ -11,8 +15,11 @@ from huggingface_hub import login
 from guidance.models import Transformers
 from guidance.chat import ChatTemplate
 import pickle
-from .global_cache import _GLOBAL_RERANKERS, _GLOBAL_AMBITI, _GLOBAL_TASSONOMIE, _GLOBAL_VECTOR_STORE
+from .global_cache import _GLOBAL_RERANKERS, _GLOBAL_AMBITI, _GLOBAL_TASSONOMIE, _GLOBAL_VECTOR_STORE, _GLOBAL_RETRIEVERS, _GLOBAL_CLIENTS
 import dill
+import os
+import asyncio
+import re
 # from qdrant_client import QdrantClient
 # from langchain.vectorstores import Qdrant
 import logging
@@ -20,6 +27,24 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+VECTOR_INDEX_PATH = "aixparag/data/vector_index"
+EMBEDDING_MODEL_NAME = 'dbmdz/bert-base-italian-uncased'
+# run router, metadata extraction and retrieval concurrently with the query rewrite
+SPECULATIVE_ROUTING = True
+# the speculative router decision and metadata are kept when the rewritten query keeps
+# at least this share of the words of the last turn (a rewrite mostly adds context)
+SPECULATION_MIN_OVERLAP = 0.5
+# rerank the retrieved candidates in growing slices instead of all of them
+ADAPTIVE_RERANK = True
+# fuse the dense search with a BM25 search (names, titles, acronyms)
+HYBRID_RETRIEVAL = True
+# candidates retrieved for the reranker
+RETRIEVAL_K = 50
+# actions passed to the answer on a DB_QUERY turn
+DB_QUERY_LIMIT = 10
+# EMBEDDING_MODEL_NAME = 'BAAI/bge-m3'
+# store written by older versions (pickled in-memory Qdrant + embedding model)
+LEGACY_VECTOR_STORE_PATH = "aixparag/data/vector_store.pkl"
 
 
 def find_cities_in_first_lines(documents):
@@ -32,24 +57,19 @@ def find_cities_in_first_lines(documents):
     Returns:
         list[str]: List of cities found in the first lines of the documents.
     """
-    # Load cities from file
-    
-    with open("aixparag/data/cities.txt", "r", encoding="utf-8") as f:
-        cities = [line.strip() for line in f if line.strip()]
-    
-    found_cities = []
+    # the city list is compiled once (see gazetteer), results are memoized per first line
+    return get_gazetteer().find_in_first_lines(documents)
 
-    for doc in documents:
-        first_line = doc.splitlines()[0] if doc else ""
-        for city in cities:
-            # Case-insensitive match
-            if " "+city.lower()+" " in first_line.lower():
-                found_cities.append(city.lower())
-
-    return found_cities
 
+def create_vector_store(batch_size=DEFAULT_BATCH_SIZE, num_workers=1):
+    """
+    Creates or incrementally updates the vector index from data_and_metadata.json:
+    only new or changed actions are embedded, removed actions are deleted.
 
-def create_vector_store():
+    Args:
+        batch_size (int): Embedding batch size.
+        num_workers (int): Number of embedding processes.
+    """
     print("Creating vector store...")
     
     # CREATE VECTOR STORE
@@ -58,36 +78,93 @@ def create_vector_store():
         data = json.load(file)
     
     # loading or creating vector store
-    my_vector_store = VectorStore(collection_name="my_app_docs",
-                                  model_name='dbmdz/bert-base-italian-uncased')
-                                # model_name='BAAI/bge-m3')
+    my_vector_store = None
+    if MmapVectorStore.exists(VECTOR_INDEX_PATH):
+        my_vector_store = MmapVectorStore.load(VECTOR_INDEX_PATH)
+        if my_vector_store.model_name != EMBEDDING_MODEL_NAME:
+            print(f"Index was built with '{my_vector_store.model_name}', rebuilding with '{EMBEDDING_MODEL_NAME}'")
+            my_vector_store = None
+    if my_vector_store is None:
+        my_vector_store = MmapVectorStore(collection_name="my_app_docs",
+                                          model_name=EMBEDDING_MODEL_NAME)
 
     # creating vs (actions as chunks)
-    documents = []
-    for doc_id, item in data.items():
-        actions = [Document(page_content =  f"COMUNE DI: {item['place']}\n" + action['action_text'],
-                            metadata = {"tassonomia": metadata['tassonomia'].lower(),
-                                        "macro_ambito": metadata['macro-ambito'],
-                                        "luogo": item['place'].lower(),
-                                        "id": action['action_id']})
-                            for action,metadata in zip(item['actions'], item['actions_metadata'])]
-        documents.extend(actions)
-    my_vector_store.populate_vector_store(documents)
-    
-    with open("aixparag/data/vector_store.pkl", "wb") as f:
-        pickle.dump(my_vector_store, f)
+    documents = build_documents(data)
+    stats = sync_vector_store(my_vector_store, documents,
+                              batch_size=batch_size, num_workers=num_workers,
+                              checkpoint_path=VECTOR_INDEX_PATH)
+    # a run interrupted after a checkpoint left the index without its BM25 index
+    if (stats["added"] or stats["updated"] or stats["deleted"] or not MmapVectorStore.exists(VECTOR_INDEX_PATH)
+            or not my_vector_store.lexical_index_saved):
+        my_vector_store.save(VECTOR_INDEX_PATH)
+        _GLOBAL_VECTOR_STORE.pop("default", None)
 
     return my_vector_store
 
+def vector_store_exists():
+    return MmapVectorStore.exists(VECTOR_INDEX_PATH) or os.path.exists(LEGACY_VECTOR_STORE_PATH)
+
 def load_vector_store():
     if "default" not in _GLOBAL_VECTOR_STORE:
-        import pickle
-        with open("aixparag/data/vector_store.pkl", "rb") as f:
-            _GLOBAL_VECTOR_STORE["default"] = pickle.load(f)
+        if MmapVectorStore.exists(VECTOR_INDEX_PATH):
+            _GLOBAL_VECTOR_STORE["default"] = MmapVectorStore.load(VECTOR_INDEX_PATH)
+        else:
+            logger.warning(f"No index in '{VECTOR_INDEX_PATH}', loading legacy pickled store '{LEGACY_VECTOR_STORE_PATH}'")
+            with open(LEGACY_VECTOR_STORE_PATH, "rb") as f:
+                _GLOBAL_VECTOR_STORE["default"] = pickle.load(f)
     
     return _GLOBAL_VECTOR_STORE["default"]
 
 
+def get_retriever():
+    """
+    Retriever over the default vector store, shared across requests
+    (rebuilt only if the store has been reloaded).
+    """
+    my_vector_store = load_vector_store()
+    reranker_model_name = _GLOBAL_RERANKERS["reranker_hf_model"]
+    my_retriever = _GLOBAL_RETRIEVERS.get(reranker_model_name)
+    if my_retriever is None or my_retriever.vector_store is not my_vector_store:
+        my_retriever = Retriever(vector_store=my_vector_store, reranker_model_name=reranker_model_name,
+                                 hybrid=HYBRID_RETRIEVAL)
+        _GLOBAL_RETRIEVERS[reranker_model_name] = my_retriever
+    return my_retriever
+
+
+def get_vllm_model():
+    # per process, as the pooled client it wraps: a forked worker must not reuse the parent's connections
+    key = ("vllm_model", os.getpid())
+    if key not in _GLOBAL_CLIENTS:
+        _GLOBAL_CLIENTS[key] = VLLMModel()
+    return _GLOBAL_CLIENTS[key]
+
+
+def get_async_vllm_model():
+    # per process, as the pooled async client it wraps
+    key = ("async_vllm_model", os.getpid())
+    if key not in _GLOBAL_CLIENTS:
+        _GLOBAL_CLIENTS[key] = AsyncVLLMModel()
+    return _GLOBAL_CLIENTS[key]
+
+
+def warmup():
+    """
+    Loads everything the request path needs (vector index, embedding model,
+    reranker, metadata cache), so that it happens once before serving, e.g. in
+    the parent process before forking the workers.
+    """
+    my_vector_store = load_vector_store()
+    my_vector_store.embeddings
+    if isinstance(my_vector_store, MmapVectorStore):
+        my_vector_store.index_metadata()
+    if get_retriever().hybrid:
+        # loads the BM25 index
+        my_vector_store.lexical_search("", k=1)
+    if not _GLOBAL_TASSONOMIE:
+        load_metadata_cache()
+    get_gazetteer()
+
+
 def convert_conversation_format(dialogue_list):
     conversation = []
     for turn in dialogue_list:
@@ -97,23 +174,12 @@ def convert_conversation_format(dialogue_list):
 # # loading retriever
 def rag_answer(documents_list, dialogue_list, query, options_number, hf_token, chatbot_is_first):
     my_vector_store = load_vector_store()
-    my_retriever = Retriever(vector_store=my_vector_store, reranker_model_name=_GLOBAL_RERANKERS["reranker_hf_model"])
+    my_retriever = get_retriever()
 
     luoghi = find_cities_in_first_lines(documents_list)
+    tassonomie, ambiti = _dialogue_metadata(luoghi)
 
-    tassonomie_dialogo = []
-    ambiti_dialogo = []
-
-    for city in luoghi:
-        if city in _GLOBAL_TASSONOMIE and _GLOBAL_TASSONOMIE[city]:
-            tassonomie_dialogo.extend(_GLOBAL_TASSONOMIE[city])
-        if city in _GLOBAL_AMBITI and _GLOBAL_AMBITI[city]:
-            ambiti_dialogo.extend(_GLOBAL_AMBITI[city])  
-    
-    tassonomie = list(set(tassonomie_dialogo))
-    ambiti = list(set(ambiti_dialogo))
-
-    vllm_model = VLLMModel()
+    vllm_model = get_vllm_model()
     conversation = convert_conversation_format(dialogue_list)
     query = utils.expand_query(vllm_model, conversation)
     logger.info("Expanded query:")
@@ -132,31 +198,23 @@ def rag_answer(documents_list, dialogue_list, query, options_number, hf_token, c
             logger.info("Using DB_QUERY")
             response_dict = utils.exctract_metadata(vllm_model, query, conversation, tassonomie, ambiti, luoghi)
             logger.info(f"Filters for retrieval: {response_dict}")
-            search_results = my_vector_store.db_select(filters=response_dict, limit=10)
-            retrieved_results =[el.payload['page_content'] for el in search_results[0]]
-            return retrieved_results
+            return _db_query(my_vector_store, response_dict)
 
         else:
             logger.info("Using SEMANTIC_SEARCH")
-            response_dict = dict()
-            response_dict['luogo'] =  luoghi
-            logger.info(f"Filters for retrieval: {response_dict}")
-            search_results = my_retriever.retrieve(query, k=50, filters=response_dict)
-            filtered_results = my_retriever.rerank(query, search_results, k=5)
-            retrieved_results = [el['page_content'] for el in filtered_results]
-            # logger.info("Retrieved results:")
-            # logger.info(retrieved_results)
-            return retrieved_results
+            return _semantic_search(my_retriever, query, luoghi)
 
 
 
 def rag_answer_highlight(documents_list, query, options_number, hf_token):
 
     my_vector_store = load_vector_store()
-    
-
     luoghi = find_cities_in_first_lines(documents_list)
+    my_retriever = get_retriever()
+    return _semantic_search_scores(my_retriever, query, luoghi)
 
+
+def _dialogue_metadata(luoghi):
     tassonomie_dialogo = []
     ambiti_dialogo = []
 
@@ -164,16 +222,190 @@ def rag_answer_highlight(documents_list, query, options_number, hf_token):
         if city in _GLOBAL_TASSONOMIE and _GLOBAL_TASSONOMIE[city]:
             tassonomie_dialogo.extend(_GLOBAL_TASSONOMIE[city])
         if city in _GLOBAL_AMBITI and _GLOBAL_AMBITI[city]:
-            ambiti_dialogo.extend(_GLOBAL_AMBITI[city])  
-    
-    my_retriever = Retriever(vector_store=my_vector_store, reranker_model_name=_GLOBAL_RERANKERS["reranker_hf_model"])    
+            ambiti_dialogo.extend(_GLOBAL_AMBITI[city])
+
+    return list(set(tassonomie_dialogo)), list(set(ambiti_dialogo))
+
+
+def _db_query(my_vector_store, response_dict):
+    # only the texts of the first DB_QUERY_LIMIT points are read
+    records = my_vector_store.iter_select(filters=response_dict, fields=["page_content"], limit=DB_QUERY_LIMIT)
+    return [el.payload['page_content'] for el in records]
+
+
+def _semantic_search(my_retriever, query, luoghi):
     response_dict = dict()
     response_dict['luogo'] =  luoghi
-    
-    search_results = my_retriever.retrieve(query, k=50, filters=response_dict)
-    
-    filtered_results,results_scores = my_retriever.rerank_scores(query, search_results, k=5)
-    
+    logger.info(f"Filters for retrieval: {response_dict}")
+    search_results = my_retriever.retrieve(query, k=RETRIEVAL_K, filters=response_dict)
+    filtered_results = _rerank(my_retriever, query, search_results, response_dict)
+    return [el['page_content'] for el in filtered_results]
+
+
+def _rerank(my_retriever, query, candidates, filters):
+    if ADAPTIVE_RERANK:
+        return my_retriever.rerank_adaptive(query, candidates, k=5,
+                                            collection_size=my_retriever.filtered_size(filters))
+    return my_retriever.rerank(query, candidates, k=5)
+
+
+def _semantic_search_scores(my_retriever, query, luoghi):
+    response_dict = dict()
+    response_dict['luogo'] =  luoghi
+    search_results = my_retriever.retrieve(query, k=RETRIEVAL_K, filters=response_dict)
+    if ADAPTIVE_RERANK:
+        filtered_results,results_scores = my_retriever.rerank_adaptive(query, search_results, k=5, cutoff=True,
+                                                                       collection_size=my_retriever.filtered_size(response_dict))
+    else:
+        filtered_results,results_scores = my_retriever.rerank_scores(query, search_results, k=5)
+    return [el['page_content'] for el in filtered_results]
+
+
+def _same_query(a, b):
+    return re.sub(r"\W+", " ", a.lower()).strip() == re.sub(r"\W+", " ", b.lower()).strip()
+
+
+def _content_words(text):
+    # words of three letters or more: articles and most prepositions are left out
+    return {word for word in re.findall(r"\w+", text.lower()) if len(word) > 2}
+
+
+def _speculation_holds(query, raw_query, min_overlap=SPECULATION_MIN_OVERLAP):
+    """
+    Whether routing and metadata computed on the raw last turn can stand for the
+    rewritten query: the rewrite keeps most of the content words of the turn.
+    """
+    raw_words = _content_words(raw_query)
+    if not raw_words:
+        return _same_query(query, raw_query)
+    return len(raw_words & _content_words(query)) / len(raw_words) >= min_overlap
+
+
+def _merge_candidates(primary, secondary, k):
+    """
+    Merges two candidate lists without duplicates, ordered by retrieval score (the
+    order rerank_adaptive expects), up to k. Ties keep the primary list first.
+    """
+    def score(doc):
+        return doc.metadata.get("_score", float("-inf"))
+
+    best = {}
+    for doc in primary + secondary:
+        current = best.get(doc.page_content)
+        if current is None or score(doc) > score(current):
+            best[doc.page_content] = doc
+    return sorted(best.values(), key=score, reverse=True)[:k]
+
+
+def _discard(task):
+    # cancels a speculative task whose result is no longer needed (an in-flight
+    # LLM request is aborted) and swallows its outcome
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+def _reconcile_semantic_search(my_retriever, query, raw_query, speculative_results, luoghi):
+    """
+    Reranks the candidates of the speculative search on the raw last turn, merged
+    with a search on the rewritten query when the rewrite changed it.
+    """
+    candidates = speculative_results
+    response_dict = dict()
+    response_dict['luogo'] =  luoghi
+    if not _same_query(query, raw_query):
+        rewritten_results = my_retriever.retrieve(query, k=RETRIEVAL_K, filters=response_dict)
+        candidates = _merge_candidates(rewritten_results, speculative_results, RETRIEVAL_K)
+    filtered_results = _rerank(my_retriever, query, candidates, response_dict)
+    return [el['page_content'] for el in filtered_results]
+
+
+async def rag_answer_async(documents_list, dialogue_list, query, options_number, hf_token, chatbot_is_first):
+    """
+    Asyncio version of rag_answer: LLM calls are awaited on an AsyncVLLMModel and
+    the CPU-bound retrieval and reranking run in the default executor, so the
+    event loop keeps serving other requests meanwhile.
+
+    With SPECULATIVE_ROUTING the router, the metadata extraction and a semantic
+    search start on the raw last turn while the query is being rewritten, and
+    are reconciled when the rewrite returns:
+    - the router decision and the extracted metadata are kept if the rewrite
+      kept most of the words of the last turn (see _speculation_holds), as it
+      usually only adds context from the dialogue; otherwise they are computed
+      again on the rewritten query (as in rag_answer);
+    - the raw-turn candidates are merged by score with those of the rewritten
+      query before reranking with the rewritten query.
+    Unused speculative work is cancelled.
+    """
+    my_vector_store = load_vector_store()
+    my_retriever = get_retriever()
+
+    luoghi = find_cities_in_first_lines(documents_list)
+    tassonomie, ambiti = _dialogue_metadata(luoghi)
+
+    vllm_model = get_async_vllm_model()
+    conversation = convert_conversation_format(dialogue_list)
+
+    if not SPECULATIVE_ROUTING:
+        query = await utils.expand_query_async(vllm_model, conversation)
+        logger.info("Expanded query:")
+        logger.info(query)
+
+        router = await utils.sql_planner_async(vllm_model, query)
+        if router == "DB_QUERY":
+            logger.info("Using DB_QUERY")
+            response_dict = await utils.exctract_metadata_async(vllm_model, query, conversation, tassonomie, ambiti, luoghi)
+            logger.info(f"Filters for retrieval: {response_dict}")
+            return await asyncio.to_thread(_db_query, my_vector_store, response_dict)
 
-    retrieved_results = [el['page_content'] for el in filtered_results]
-    return retrieved_results
\ No newline at end of file
+        logger.info("Using SEMANTIC_SEARCH")
+        return await asyncio.to_thread(_semantic_search, my_retriever, query, luoghi)
+
+    raw_query = conversation[-1]
+    rewrite_task = asyncio.create_task(utils.expand_query_async(vllm_model, conversation))
+    router_task = asyncio.create_task(utils.sql_planner_async(vllm_model, raw_query))
+    metadata_task = asyncio.create_task(
+        utils.exctract_metadata_async(vllm_model, raw_query, conversation, tassonomie, ambiti, luoghi))
+    search_task = asyncio.ensure_future(
+        asyncio.to_thread(my_retriever.retrieve, raw_query, k=RETRIEVAL_K, filters={'luogo': luoghi}))
+
+    try:
+        query = await rewrite_task
+        logger.info("Expanded query:")
+        logger.info(query)
+        speculation_holds = _speculation_holds(query, raw_query)
+        if speculation_holds:
+            router = await router_task
+        else:
+            _discard(router_task)
+            router = await utils.sql_planner_async(vllm_model, query)
+    except BaseException:
+        for task in (router_task, metadata_task, search_task):
+            _discard(task)
+        raise
+
+    if router == "DB_QUERY":
+        logger.info("Using DB_QUERY")
+        _discard(search_task)
+        if speculation_holds:
+            response_dict = await metadata_task
+        else:
+            _discard(metadata_task)
+            response_dict = await utils.exctract_metadata_async(vllm_model, query, conversation, tassonomie, ambiti, luoghi)
+        logger.info(f"Filters for retrieval: {response_dict}")
+        return await asyncio.to_thread(_db_query, my_vector_store, response_dict)
+
+    logger.info("Using SEMANTIC_SEARCH")
+    _discard(metadata_task)
+    speculative_results = await search_task
+    return await asyncio.to_thread(_reconcile_semantic_search, my_retriever, query, raw_query,
+                                   speculative_results, luoghi)
+
+
+async def rag_answer_highlight_async(documents_list, query, options_number, hf_token):
+    """
+    Asyncio version of rag_answer_highlight, running retrieval and reranking in the default executor.
+    """
+    my_vector_store = load_vector_store()
+    luoghi = find_cities_in_first_lines(documents_list)
+    my_retriever = get_retriever()
+    return await asyncio.to_thread(_semantic_search_scores, my_retriever, query, luoghi)
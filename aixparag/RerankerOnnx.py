@@ -0,0 +1,190 @@
+"""
+Cross-encoder reranker running on ONNX Runtime, optionally int8-quantized
+
+The HuggingFace model is exported to ONNX once (and quantized with dynamic int8
+quantization) into ``aixparag/data/onnx/<model>``; later runs load the exported
+file. ``predict`` has the same input and output of ``CrossEncoder.predict``, so
+the Retriever can use either backend (see ``--reranker_backend`` in start_api).
+
+Running this module (``python -m aixparag.RerankerOnnx``) compares the ONNX
+backend with the PyTorch one on the actions of the vector index (score
+correlation, top-k agreement and latency).
+"""
+
+import os
+import platform
+import time
+from typing import List, Optional
+
+import numpy as np
+
+DEFAULT_ONNX_DIR = "aixparag/data/onnx"
+QUANTIZED_FILE = "model_quantized.onnx"
+EXPORTED_FILE = "model.onnx"
+
+
+class OnnxCrossEncoder:
+    """
+    Drop-in replacement of ``sentence_transformers.CrossEncoder`` for CPU inference.
+
+    The ONNX Runtime session is created lazily in each process (its thread pool does
+    not survive a fork), with ``num_threads`` intra-op threads, by default the torch
+    thread count of the process (set per worker by start_api.serve_prefork).
+    """
+
+    def __init__(self,
+                 model_name: str,
+                 quantize: bool = True,
+                 num_threads: Optional[int] = None,
+                 onnx_dir: str = DEFAULT_ONNX_DIR,
+                 max_length: int = 512,
+                 batch_size: int = 32):
+        """
+        Args:
+            model_name (str): HuggingFace cross-encoder to export.
+            quantize (bool): Use the int8 dynamically quantized model.
+            num_threads (Optional[int]): Intra-op threads of the session.
+            onnx_dir (str): Where the exported models are kept.
+            max_length (int): Maximum number of tokens of a (query, passage) pair.
+            batch_size (int): Pairs per inference call.
+        """
+        from transformers import AutoConfig, AutoTokenizer
+
+        self.model_name = model_name
+        self.quantize = quantize
+        self.num_threads = num_threads
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.model_dir = os.path.join(onnx_dir, model_name.replace("/", "__"))
+        self.file_name = QUANTIZED_FILE if quantize else EXPORTED_FILE
+
+        self.export()
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+        self.activation = self._activation(AutoConfig.from_pretrained(self.model_dir))
+        self._model = None
+        self._pid = None
+
+    def export(self):
+        """
+        Exports (and quantizes) the model, unless it has already been done.
+        """
+        if os.path.exists(os.path.join(self.model_dir, self.file_name)):
+            return
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        from transformers import AutoTokenizer
+
+        print(f"Exporting reranker '{self.model_name}' to ONNX in '{self.model_dir}'...")
+        model = ORTModelForSequenceClassification.from_pretrained(self.model_name, export=True)
+        model.save_pretrained(self.model_dir)
+        AutoTokenizer.from_pretrained(self.model_name).save_pretrained(self.model_dir)
+
+        if self.quantize:
+            from optimum.onnxruntime import ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+            if platform.machine().lower() in ("arm64", "aarch64"):
+                qconfig = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+            else:
+                qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            quantizer = ORTQuantizer.from_pretrained(model)
+            quantizer.quantize(save_dir=self.model_dir, quantization_config=qconfig)
+        print("Reranker exported.")
+
+    @staticmethod
+    def _activation(config):
+        # as CrossEncoder: sigmoid on single-label models unless the model asks for none
+        st_config = getattr(config, "sentence_transformers", None) or {}
+        name = st_config.get("activation_fn") or getattr(config, "sbert_ce_default_activation_function", None) or ""
+        if config.num_labels != 1 or name.endswith("Identity"):
+            return lambda logits: logits
+        return lambda logits: 1 / (1 + np.exp(-logits))
+
+    def _session(self):
+        if self._model is None or self._pid != os.getpid():
+            import onnxruntime
+            import torch
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = self.num_threads or torch.get_num_threads()
+            options.inter_op_num_threads = 1
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._model = ORTModelForSequenceClassification.from_pretrained(
+                self.model_dir, file_name=self.file_name, session_options=options,
+                provider="CPUExecutionProvider")
+            self._pid = os.getpid()
+        return self._model
+
+    def predict(self, sentence_pairs: List[List[str]], batch_size: Optional[int] = None) -> np.ndarray:
+        """
+        Scores of (query, passage) pairs, as CrossEncoder.predict.
+        """
+        model = self._session()
+        batch_size = batch_size or self.batch_size
+        scores = np.empty(len(sentence_pairs), dtype=np.float32)
+        # length buckets: each batch pads to similar lengths
+        order = sorted(range(len(sentence_pairs)), key=lambda i: len(sentence_pairs[i][0]) + len(sentence_pairs[i][1]))
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            inputs = self.tokenizer([sentence_pairs[i][0] for i in batch], [sentence_pairs[i][1] for i in batch],
+                                    padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+            logits = np.asarray(model(**inputs).logits, dtype=np.float32)
+            scores[batch] = self.activation(logits[:, 0] if logits.shape[1] == 1 else logits.max(axis=1))
+        return scores
+
+
+def _ranks(values: np.ndarray) -> np.ndarray:
+    ranks = np.empty(len(values), dtype=np.float64)
+    ranks[np.argsort(values, kind="stable")] = np.arange(len(values))
+    return ranks
+
+
+def compare_backends(model_name: str, queries: List[str], passages: List[str], k: int = 5, repeats: int = 3):
+    """
+    Scores every query against ``passages`` with the PyTorch and the ONNX int8 backends and
+    prints the Spearman correlation of the scores, the top-k overlap and the mean latency.
+    """
+    from sentence_transformers import CrossEncoder
+
+    backends = {"torch": CrossEncoder(model_name),
+                "onnx-int8": OnnxCrossEncoder(model_name, quantize=True)}
+    scores, latency = {}, {}
+    for name, backend in backends.items():
+        backend.predict([[queries[0], passages[0]]])  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            scores[name] = [np.asarray(backend.predict([[query, passage] for passage in passages]))
+                            for query in queries]
+        latency[name] = (time.perf_counter() - start) / (repeats * len(queries))
+
+    spearman, overlap = [], []
+    for reference, candidate in zip(scores["torch"], scores["onnx-int8"]):
+        spearman.append(np.corrcoef(_ranks(reference), _ranks(candidate))[0, 1])
+        top_reference = set(np.argsort(-reference)[:k])
+        top_candidate = set(np.argsort(-candidate)[:k])
+        overlap.append(len(top_reference & top_candidate) / k)
+
+    print(f"{len(queries)} queries x {len(passages)} passages")
+    for name in backends:
+        print(f"{name:>10}: {latency[name] * 1000:.1f} ms per query")
+    print(f"Spearman correlation of the scores: mean {np.mean(spearman):.4f}, min {np.min(spearman):.4f}")
+    print(f"Top-{k} overlap: mean {np.mean(overlap):.3f}, min {np.min(overlap):.3f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    from .VectorStoreMmap import MmapVectorStore
+
+    parser = argparse.ArgumentParser(description="Compare the PyTorch and ONNX int8 reranker backends")
+    parser.add_argument("--model", default="nickprock/cross-encoder-italian-bert-stsb")
+    parser.add_argument("--index", default="aixparag/data/vector_index")
+    parser.add_argument("--passages", default=50, type=int)
+    parser.add_argument("--queries", nargs="*", default=["Quali iniziative ci sono per le famiglie con bambini piccoli?",
+                                                          "Attività estive per ragazzi",
+                                                          "Sostegno economico alle famiglie numerose"])
+    args = parser.parse_args()
+
+    store = MmapVectorStore.load(args.index)
+    # the candidates the reranker would see for the first query
+    passages = [doc.page_content for doc in store.search(args.queries[0], k=args.passages)]
+    compare_backends(args.model, args.queries, passages)
@@ -1,15 +1,23 @@
 import numpy as np
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 from sentence_transformers import CrossEncoder # For reranking
 from .VectorStoreQdrant import VectorStore
+from .VectorStoreMmap import MmapVectorStore
 from .global_cache import _GLOBAL_RERANKERS  # import the global cache
+from .cache import get_rerank_cache
+from .RerankerOnnx import OnnxCrossEncoder
+import hashlib
 import statistics
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# constant of reciprocal rank fusion: a document at rank r of a list scores 1 / (RRF_K + r)
+RRF_K = 60
+
 class Retriever:
     """
     A class to handle document retrieval and optional re-ranking for RAG applications.
@@ -17,35 +25,53 @@ class Retriever:
     It wraps a VectorStore object and can optionally include a re-ranker.
     """
 
-    def __init__(self, vector_store: VectorStore, reranker_model_name: Optional[str] = None):
+    def __init__(self, vector_store: Union[VectorStore, MmapVectorStore], reranker_model_name: Optional[str] = None,
+                 hybrid: bool = False):
         """
         Initializes the Retriever with a VectorStore and an optional re-ranker.
 
         Args:
-            vector_store (VectorStore): An instance of the VectorStore class.
+            vector_store (Union[VectorStore, MmapVectorStore]): An instance of one of the vector store classes.
             reranker_model_name (Optional[str]): The name of the cross-encoder model
                                                   to use for re-ranking. If None,
                                                   re-ranking will not be performed.
                                                   (e.g., 'cross-encoder/ms-marco-MiniLM-L-6-v2').
+            hybrid (bool): Fuse the dense search with the BM25 search of the store
+                           (reciprocal rank fusion). Needs a store with ``lexical_search``.
         """
-        if not isinstance(vector_store, VectorStore):
-            raise TypeError("vector_store must be an instance of VectorStore.")
+        if not isinstance(vector_store, (VectorStore, MmapVectorStore)):
+            raise TypeError("vector_store must be an instance of VectorStore or MmapVectorStore.")
 
         self.vector_store = vector_store
+        self.hybrid = hybrid and hasattr(vector_store, "lexical_search")
+        if hybrid and not self.hybrid:
+            logger.warning(f"{type(vector_store).__name__} has no lexical index: hybrid retrieval disabled")
         self.reranker = None
+        # "torch" (CrossEncoder), "onnx" (int8 ONNX Runtime) or "onnx-fp32", set by start_api
+        self.reranker_backend = _GLOBAL_RERANKERS.get("reranker_backend", "torch")
+        # registry (and score cache) key: scores of different backends are not mixed
+        self.reranker_key = reranker_model_name if self.reranker_backend == "torch" else f"{reranker_model_name}#{self.reranker_backend}"
 
         
         if reranker_model_name:
-            if reranker_model_name not in _GLOBAL_RERANKERS:
-                print(f"Loading reranker model once: {reranker_model_name}...")
+            if self.reranker_key not in _GLOBAL_RERANKERS:
+                print(f"Loading reranker model once: {reranker_model_name} ({self.reranker_backend})...")
                 try:
-                    _GLOBAL_RERANKERS[reranker_model_name] = CrossEncoder(reranker_model_name)
+                    if self.reranker_backend == "torch":
+                        _GLOBAL_RERANKERS[self.reranker_key] = CrossEncoder(reranker_model_name)
+                    else:
+                        _GLOBAL_RERANKERS[self.reranker_key] = OnnxCrossEncoder(reranker_model_name,
+                                                                                quantize=self.reranker_backend == "onnx")
                     print("Reranker model loaded successfully.")
                 except Exception as e:
+                    if self.reranker_backend != "torch":
+                        # an explicitly requested backend must not silently disable reranking
+                        raise RuntimeError(f"Cannot load reranker '{reranker_model_name}' with the "
+                                           f"'{self.reranker_backend}' backend (it needs optimum[onnxruntime]): {e}") from e
                     print(f"Error loading reranker model: {e}")
-                    _GLOBAL_RERANKERS[reranker_model_name] = None
+                    _GLOBAL_RERANKERS[self.reranker_key] = None
 
-            self.reranker = _GLOBAL_RERANKERS[reranker_model_name]
+            self.reranker = _GLOBAL_RERANKERS[self.reranker_key]
 
         # if reranker_model_name:
         #     print(f"Initializing reranker model: {reranker_model_name}...")
@@ -57,25 +83,99 @@ class Retriever:
         #         print("Please ensure 'sentence-transformers' library is installed (`pip install sentence-transformers`).")
         #         self.reranker = None # Set to None if loading fails
 
-    def retrieve(self, query: str, k: int = 10, filters = None) -> List[Dict]:
+    def retrieve(self, query: str, k: int = 10, filters = None, query_vector = None) -> List[Dict]:
         """
         Retrieves the top-k most relevant documents from the vector store.
+
+        The query is embedded once (unless ``query_vector`` is given) and the same
+        vector serves the unfiltered fallback when the filters match nothing.
+        In hybrid mode the BM25 search runs in a thread while the query is embedded
+        and searched, and the two rankings are fused (see ``fuse``).
         """
         logger.info(f"Retrieving initial top {k} documents for query: '{query}'")
         # print(f"Using filters: {filters}")
         
         # retrieved_docs = self.vector_store.search(query, k=k)
 
-        retrieved_docs = self.vector_store.search(query, k=k, filters=filters)
-        if len(retrieved_docs) == 0:
-            # print("No documents retrieved from the vector store. Now running without filter.")
-            retrieved_docs = self.vector_store.search(query, k=k)
+        if not self.hybrid:
+            if query_vector is None:
+                query_vector = self.vector_store.embed_query(query)
+            retrieved_docs = self.vector_store.search(query, k=k, filters=filters, query_vector=query_vector)
+            if len(retrieved_docs) == 0:
+                # print("No documents retrieved from the vector store. Now running without filter.")
+                retrieved_docs = self.vector_store.search(query, k=k, query_vector=query_vector)
+            return retrieved_docs
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            lexical = executor.submit(self.vector_store.lexical_search, query, k, filters)
+            if query_vector is None:
+                query_vector = self.vector_store.embed_query(query)
+            dense_docs = self.vector_store.search(query, k=k, filters=filters, query_vector=query_vector)
+            lexical_docs = lexical.result()
+            if len(dense_docs) == 0 and len(lexical_docs) == 0:
+                lexical = executor.submit(self.vector_store.lexical_search, query, k)
+                dense_docs = self.vector_store.search(query, k=k, query_vector=query_vector)
+                lexical_docs = lexical.result()
+        retrieved_docs = self.fuse([dense_docs, lexical_docs], k)
         
    
         # logger.info(f"Found {len(retrieved_docs)} documents during initial retrieval.")
         # logger.info(retrieved_docs)
         return retrieved_docs
 
+    def filtered_size(self, filters=None) -> Optional[int]:
+        """
+        Number of points a search with ``filters`` ranks, or None if the store cannot count them.
+        """
+        if not hasattr(self.vector_store, "count"):
+            return None
+        return self.vector_store.count(filters)
+
+    @staticmethod
+    def fuse(rankings: List[List[Dict]], k: int, rrf_k: int = RRF_K) -> List[Dict]:
+        """
+        Reciprocal rank fusion of several rankings of documents (deduplicated by point id).
+
+        The fused score replaces ``_score`` in the metadata, so that ``rerank_adaptive``
+        sizes the candidate set on the fused ranking.
+        """
+        fused = {}
+        for ranking in rankings:
+            for rank, doc in enumerate(ranking):
+                key = doc.metadata.get("_id", doc.page_content)
+                if key not in fused:
+                    fused[key] = [0.0, doc]
+                fused[key][0] += 1.0 / (rrf_k + rank + 1)
+        ranked = sorted(fused.values(), key=lambda entry: entry[0], reverse=True)[:k]
+        for score, doc in ranked:
+            doc.metadata["_score"] = score
+        return [doc for score, doc in ranked]
+
+    @staticmethod
+    def _passage_id(doc) -> str:
+        # a content hash rather than the point id: an action updated in place is scored again
+        return hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()
+
+    def predict_scores(self, query: str, documents: List[Dict]) -> List[float]:
+        """
+        Cross-encoder scores of (query, document) pairs. Scores already computed for
+        the same reranker, query and passage come from the rerank score cache; only
+        the other pairs go through the model.
+        """
+        cache = get_rerank_cache()
+        if cache is None:
+            return [float(score) for score in self.reranker.predict([[query, doc.page_content] for doc in documents])]
+
+        passage_ids = [self._passage_id(doc) for doc in documents]
+        scores = cache.get_many(self.reranker_key, query, passage_ids)
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            predicted = self.reranker.predict([[query, documents[i].page_content] for i in missing])
+            cache.set_many(self.reranker_key, query, [passage_ids[i] for i in missing], predicted)
+            for i, score in zip(missing, predicted):
+                scores[i] = float(score)
+        return scores
+
     def rerank(self, query: str, documents: List[Dict], k: int = 5) -> List[Dict]:
         """
         Re-ranks a list of documents based on their relevance to the query using the reranker.
@@ -98,13 +198,10 @@ class Retriever:
             return []
 
         # print(f"Re-ranking {len(documents)} documents for query: '{query}'")
-        # Prepare pairs for the cross-encoder: (query, document_text)
-        sentence_pairs = [[query, doc.page_content] for doc in documents]
-
         # Get scores from the cross-encoder
         # The cross-encoder outputs a single score per pair, indicating relevance.
         # Higher score means higher relevance.
-        rerank_scores = self.reranker.predict(sentence_pairs)
+        rerank_scores = self.predict_scores(query, documents)
 
         # Add rerank scores to the documents and sort them
         reranked_docs = []
@@ -155,8 +252,7 @@ class Retriever:
             return [], []
 
         print(f"Re-ranking {len(documents)} documents for query: '{query}'")
-        sentence_pairs = [[query, doc.page_content] for doc in documents]
-        rerank_scores = self.reranker.predict(sentence_pairs)
+        rerank_scores = self.predict_scores(query, documents)
 
         reranked_docs = [
             {"page_content": doc.page_content, "rerank_score": float(rerank_scores[i])}
@@ -165,6 +261,20 @@ class Retriever:
 
         reranked_docs.sort(key=lambda x: x["rerank_score"], reverse=True)
 
+        final_docs = self._drop_cutoff(reranked_docs, k, z_threshold, fallback_threshold)
+        final_scores = [doc["rerank_score"] for doc in final_docs]
+
+        print("Documents re-ranked successfully.")
+        return final_docs, final_scores
+
+    @staticmethod
+    def _drop_cutoff(reranked_docs: List[Dict], k: int, z_threshold: float, fallback_threshold: float,
+                     verbose: bool = True) -> List[Dict]:
+        """
+        Keeps the first (at most k) of the sorted documents, stopping before the first
+        relative score drop that is an outlier (z-score, or a fixed threshold while
+        there are fewer than 3 drops).
+        """
         # Apply cutoff
         final_docs = [reranked_docs[0]]
         relative_drops = []
@@ -179,10 +289,11 @@ class Retriever:
             if len(relative_drops) < 3:  
                 # Fallback rule for very few documents
                 if relative_drop > fallback_threshold:
-                    print(
-                        f"Stopped early at rank {i} due to large drop "
-                        f"(relative_drop={relative_drop:.4f}, threshold={fallback_threshold})"
-                    )
+                    if verbose:
+                        print(
+                            f"Stopped early at rank {i} due to large drop "
+                            f"(relative_drop={relative_drop:.4f}, threshold={fallback_threshold})"
+                        )
                     break
             else:
                 # Statistical cutoff using z-score
@@ -191,18 +302,94 @@ class Retriever:
                 z_score = (relative_drop - mean_drop) / stdev_drop
 
                 if z_score > z_threshold:
-                    print(
-                        f"Stopped early at rank {i} due to statistical outlier "
-                        f"(relative_drop={relative_drop:.4f}, z={z_score:.2f})"
-                    )
+                    if verbose:
+                        print(
+                            f"Stopped early at rank {i} due to statistical outlier "
+                            f"(relative_drop={relative_drop:.4f}, z={z_score:.2f})"
+                        )
                     break
 
             final_docs.append(reranked_docs[i])
 
-        final_scores = [doc["rerank_score"] for doc in final_docs]
+        return final_docs
+
+    def rerank_adaptive(
+        self,
+        query: str,
+        documents: List[Dict],
+        k: int = 5,
+        slice_size: int = 10,
+        score_margin: float = 0.5,
+        cutoff: bool = False,
+        z_threshold: float = 2.0,
+        fallback_threshold: float = 0.3,
+        collection_size: Optional[int] = None
+    ):
+        """
+        Re-ranks the candidates in growing slices, so the cross-encoder only scores the ones that matter.
+
+        The first slice holds at least 2*k candidates plus every candidate whose vector
+        score (``_score`` metadata) is in the top ``score_margin`` fraction of the score
+        range, so a flat score distribution starts deeper than a clear winner. Further
+        slices of ``slice_size`` candidates (in vector order) are scored until one of
+        them leaves the relevant head unchanged: the top-k cut at the first outlier
+        score drop (the drop detection of rerank_scores), so a clear winner stops the
+        cascade earlier than a flat top-k. When the filtered collection
+        (``collection_size``, see filtered_size) is within one slice of the first
+        depth, all the candidates are scored in a single call instead.
 
-        print("Documents re-ranked successfully.")
-        return final_docs, final_scores
+        Args:
+            query (str): The original search query.
+            documents (List[Dict]): Candidates ordered by vector score.
+            k (int): Maximum number of documents to return.
+            slice_size (int): Candidates added at each step.
+            score_margin (float): Fraction of the vector score range covered by the first slice.
+            cutoff (bool): Apply the score-drop cutoff of rerank_scores and also return the scores.
+            collection_size (Optional[int]): Number of points the filters of the search left
+                                             (0 or None when unknown, e.g. after the unfiltered fallback).
+
+        Returns:
+            As rerank, or as rerank_scores when cutoff is True.
+        """
+        if not self.reranker or not documents:
+            return self.rerank_scores(query, documents, k, z_threshold, fallback_threshold) if cutoff \
+                else self.rerank(query, documents, k)
+
+        depth = 2 * k
+        vector_scores = [doc.metadata.get("_score") for doc in documents]
+        if all(score is not None for score in vector_scores):
+            best, worst = max(vector_scores), min(vector_scores)
+            threshold = best - score_margin * (best - worst)
+            depth = max(depth, sum(score >= threshold for score in vector_scores))
+        if collection_size and collection_size <= depth + slice_size:
+            # a small filtered collection: a further slice would save little and cost a call
+            depth = len(documents)
+        depth = min(depth, len(documents))
+
+        def head(scores):
+            # indices of the top-k documents before the first outlier drop
+            ranked = [{"index": int(i), "rerank_score": float(scores[i])} for i in np.argsort(scores)[::-1][:k]]
+            return {doc["index"] for doc in self._drop_cutoff(ranked, k, z_threshold, fallback_threshold, verbose=False)}
+
+        scores = self.predict_scores(query, documents[:depth])
+        top = head(scores)
+        while depth < len(documents):
+            next_depth = min(depth + slice_size, len(documents))
+            scores = scores + self.predict_scores(query, documents[depth:next_depth])
+            depth = next_depth
+            new_top = head(scores)
+            if new_top == top:
+                break
+            top = new_top
+        logger.info(f"Adaptive rerank: scored {depth}/{len(documents)} candidates")
+
+        reranked_docs = [{"page_content": doc.page_content, "rerank_score": float(score)}
+                         for doc, score in zip(documents, scores)]
+        reranked_docs.sort(key=lambda x: x["rerank_score"], reverse=True)
+        if not cutoff:
+            return reranked_docs[:k]
+        final_docs = self._drop_cutoff(reranked_docs, k, z_threshold, fallback_threshold)
+        return final_docs, [doc["rerank_score"] for doc in final_docs]
 
 
     def evaluate(self, retrieved_documents: List[Dict], ground_truth: List[str]) -> Dict:
@@ -0,0 +1,568 @@
+"""
+VectorStore Class backed by memory-mapped files
+
+The index is a directory holding:
+
+- a ``.npy`` matrix of L2-normalized embeddings (float16 or float32), opened
+  with ``mmap_mode='r'`` so that every process mapping the same index shares
+  its pages through the OS page cache;
+- a ``.jsonl`` sidecar with one payload (``page_content`` + ``metadata``) per row,
+  read lazily by byte offset;
+- a ``bm25-*`` directory with the BM25 index of the page contents (see
+  ``tools.bm25``), used by ``lexical_search`` for hybrid retrieval;
+- ``index.json``, the metadata index (collection, embedding model, dtype,
+  row ids, payload offsets and the metadata columns used for filtering).
+
+Only data is written to disk: the embedding model is loaded by name on the first
+query and shared through ``_GLOBAL_EMBEDDINGS``.
+"""
+
+import json
+import mmap
+import os
+import shutil
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Any
+from uuid import uuid4
+
+import numpy as np
+from langchain_core.documents import Document
+
+from tools.bm25 import BM25Index, TOKENIZERS
+
+from .global_cache import _GLOBAL_EMBEDDINGS
+from .cache import CachedEmbeddings
+from .indexer import FILTER_KEYS
+
+INDEX_FILE = "index.json"
+FORMAT_VERSION = 1
+# rows converted to float32 at a time when scoring a float16 matrix
+SCORE_BLOCK_SIZE = 8192
+# tokenizer of the BM25 index (a name of tools.bm25.TOKENIZERS)
+LEXICAL_TOKENIZER = "word"
+# points fetched at a time by iter_select
+SELECT_PAGE_SIZE = 100
+
+
+def get_embeddings(model_name: str):
+    """
+    Returns the embedding model registered under ``model_name``, loading it once per process.
+    The model is wrapped by CachedEmbeddings, so a text is never embedded twice.
+    """
+    if model_name not in _GLOBAL_EMBEDDINGS:
+        from langchain_huggingface import HuggingFaceEmbeddings
+        print(f"Loading embedding model once: {model_name}...")
+        _GLOBAL_EMBEDDINGS[model_name] = CachedEmbeddings(HuggingFaceEmbeddings(model_name=model_name), model_name)
+    return _GLOBAL_EMBEDDINGS[model_name]
+
+
+def _is_scalar(value) -> bool:
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+@dataclass
+class Record:
+    """
+    Point returned by ``db_select``, shaped like a qdrant ``Record`` (``id`` and ``payload``).
+    """
+    id: str
+    payload: Dict[str, Any]
+
+
+class _PayloadFile:
+    """
+    Read-only, lazily decoded view over the ``.jsonl`` payload sidecar.
+    """
+
+    def __init__(self, path: str, offsets: List[int]):
+        self._offsets = offsets
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        start = self._offsets[i]
+        end = self._offsets[i + 1] if i + 1 < len(self._offsets) else len(self._mmap)
+        return json.loads(self._mmap[start:end])
+
+
+class MmapVectorStore:
+    """
+    A vector store keeping normalized embeddings in a memory-mapped array, with
+    the same search/db_select interface as the Qdrant ``VectorStore``.
+
+    Build it in memory with ``populate_vector_store`` and persist it with ``save``;
+    serving processes open it with ``MmapVectorStore.load``, which only maps the
+    files and returns in milliseconds.
+    """
+
+    def __init__(self, collection_name: str = "demo_collection",
+                 model_name: str = "dbmdz/bert-base-italian-uncased",
+                 dtype: str = "float16"):
+        """
+        Initializes an empty in-memory store.
+
+        Args:
+            collection_name (str): Name of the collection, kept in the metadata index.
+            model_name (str): HuggingFace model used to embed documents and queries.
+            dtype (str): On-disk dtype of the vectors, "float16" or "float32".
+        """
+        print(f"Initializing MmapVectorStore with collection: '{collection_name}'...")
+        self.collection_name = collection_name
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        self.path = None
+
+        self._ids: List[str] = []
+        # set of self._ids, built on the first write and kept up to date
+        self._id_set: Optional[set] = None
+        self._hashes: List[Optional[str]] = []
+        self._vectors = None
+        # batches appended since the last read, concatenated lazily by _get_vectors
+        self._pending_vectors: List[np.ndarray] = []
+        self._payloads = []
+        self._metadata: Dict[str, List[Any]] = {}
+        # BM25 index of the page contents, loaded or built on first use
+        self._bm25: Optional[BM25Index] = None
+        self._bm25_dir: Optional[str] = None
+        self._bm25_tokenizer = LEXICAL_TOKENIZER
+        # inverted index of the metadata columns: key -> value -> sorted row ids
+        self._postings: Dict[str, Dict[Any, np.ndarray]] = {}
+
+    @property
+    def embeddings(self):
+        return get_embeddings(self.model_name)
+
+    def __len__(self):
+        return len(self._ids)
+
+    # ------------------------------------------------------------------ #
+    # persistence
+    # ------------------------------------------------------------------ #
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, INDEX_FILE))
+
+    @classmethod
+    def load(cls, path: str) -> "MmapVectorStore":
+        """
+        Opens an index written by ``save``. Vectors and payloads are memory-mapped, not read.
+        """
+        with open(os.path.join(path, INDEX_FILE), "r", encoding="utf-8") as f:
+            index = json.load(f)
+
+        store = cls.__new__(cls)
+        store.collection_name = index["collection_name"]
+        store.model_name = index["model_name"]
+        store.dtype = np.dtype(index["dtype"])
+        store.path = path
+        store._ids = index["ids"]
+        store._id_set = None
+        store._hashes = index.get("hashes") or [None] * len(store._ids)
+        store._metadata = index["metadata"]
+        store._vectors = np.load(os.path.join(path, index["vectors_file"]), mmap_mode="r")
+        store._pending_vectors = []
+        store._payloads = _PayloadFile(os.path.join(path, index["payloads_file"]), index["payload_offsets"])
+        store._bm25 = None
+        store._bm25_dir = index.get("bm25_dir")
+        store._bm25_tokenizer = index.get("bm25_tokenizer", LEXICAL_TOKENIZER)
+        store._postings = {}
+        print(f"Loaded MmapVectorStore '{store.collection_name}' with {len(store)} vectors from '{path}'.")
+        return store
+
+    @property
+    def lexical_index_saved(self) -> bool:
+        """
+        Whether the saved index has an up-to-date BM25 index (checkpoints have none).
+        """
+        return self._bm25_dir is not None
+
+    def save(self, path: Optional[str] = None, checkpoint: bool = False):
+        """
+        Writes the store to ``path``.
+
+        Data files are written under a fresh name and ``index.json`` is replaced last,
+        so processes that already mapped the previous version keep a consistent view.
+        The BM25 index is written only if the corpus changed since it was last saved,
+        and not at all with ``checkpoint`` (ingestion checkpoints): a store loaded
+        from a checkpoint builds it on first use, or on its next full save.
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path given to save the vector store.")
+        os.makedirs(path, exist_ok=True)
+
+        previous = None
+        if self.exists(path):
+            with open(os.path.join(path, INDEX_FILE), "r", encoding="utf-8") as f:
+                previous = json.load(f)
+
+        version = uuid4().hex[:12]
+        vectors_file = f"vectors-{version}.npy"
+        payloads_file = f"payloads-{version}.jsonl"
+
+        np.save(os.path.join(path, vectors_file), np.asarray(self._get_vectors(), dtype=self.dtype))
+
+        offsets = []
+        position = 0
+        with open(os.path.join(path, payloads_file), "wb") as f:
+            for i in range(len(self._ids)):
+                line = json.dumps(self._payloads[i], ensure_ascii=False).encode("utf-8") + b"\n"
+                offsets.append(position)
+                position += len(line)
+                f.write(line)
+
+        if checkpoint:
+            bm25_dir = None
+        elif self._bm25_dir is not None and self.path == path:
+            # no writes since the BM25 index was saved here: keep its files
+            bm25_dir = self._bm25_dir
+        else:
+            bm25_dir = f"bm25-{version}"
+            self._get_bm25().save(os.path.join(path, bm25_dir))
+
+        index = {
+            "format_version": FORMAT_VERSION,
+            "collection_name": self.collection_name,
+            "model_name": self.model_name,
+            "dtype": self.dtype.name,
+            "dim": int(self._get_vectors().shape[1]),
+            "count": len(self._ids),
+            "vectors_file": vectors_file,
+            "payloads_file": payloads_file,
+            "bm25_dir": bm25_dir,
+            "bm25_tokenizer": self._bm25_tokenizer,
+            "ids": self._ids,
+            "hashes": self._hashes,
+            "payload_offsets": offsets,
+            "metadata": self._metadata,
+        }
+        tmp_index = os.path.join(path, f"{INDEX_FILE}.{version}.tmp")
+        with open(tmp_index, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_index, os.path.join(path, INDEX_FILE))
+
+        if previous is not None:
+            for key in ("vectors_file", "payloads_file"):
+                if previous[key] != index[key]:
+                    try:
+                        os.remove(os.path.join(path, previous[key]))
+                    except OSError:
+                        pass
+            if previous.get("bm25_dir") not in (None, bm25_dir):
+                shutil.rmtree(os.path.join(path, previous["bm25_dir"]), ignore_errors=True)
+
+        self.path = path
+        self._bm25_dir = bm25_dir
+        print(f"MmapVectorStore saved to '{path}' ({len(self._ids)} vectors, {self.dtype.name}).")
+
+    # ------------------------------------------------------------------ #
+    # writes
+    # ------------------------------------------------------------------ #
+
+    def _get_vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            if self._pending_vectors:
+                dim = self._pending_vectors[0].shape[1]
+            else:
+                dim = len(self.embeddings.embed_query("This is a test sentence."))
+            self._vectors = np.zeros((0, dim), dtype=self.dtype)
+        if self._pending_vectors:
+            self._vectors = np.vstack([self._vectors] + self._pending_vectors)
+            self._pending_vectors = []
+        return self._vectors
+
+    def _materialize(self):
+        """
+        Copies a memory-mapped store into process memory so it can be modified.
+        """
+        # the BM25 and metadata indexes are rebuilt on their next use
+        self._bm25 = None
+        self._bm25_dir = None
+        self._postings = {}
+        if isinstance(self._payloads, _PayloadFile):
+            self._payloads = [self._payloads[i] for i in range(len(self._payloads))]
+            self._vectors = np.array(self._vectors)
+
+    def content_hashes(self) -> Dict[str, Optional[str]]:
+        """
+        Returns the content hash recorded for each point id (None if unknown).
+        """
+        return dict(zip(self._ids, self._hashes))
+
+    def delete(self, ids: List[str]):
+        """
+        Removes the points with the given ids.
+        """
+        to_delete = set(ids)
+        keep = [row for row, point_id in enumerate(self._ids) if point_id not in to_delete]
+        if len(keep) == len(self._ids):
+            return
+        self._materialize()
+        self._vectors = self._get_vectors()[keep]
+        self._ids = [self._ids[row] for row in keep]
+        self._id_set = None
+        self._hashes = [self._hashes[row] for row in keep]
+        self._payloads = [self._payloads[row] for row in keep]
+        self._metadata = {key: [column[row] for row in keep] for key, column in self._metadata.items()}
+
+    def add_embeddings(self, ids: List[str], vectors, documents: List[Document],
+                       hashes: Optional[List[str]] = None):
+        """
+        Adds precomputed embeddings and their documents to the store.
+        Points whose id is already present are replaced.
+        """
+        self._materialize()
+        if self._id_set is None:
+            self._id_set = set(self._ids)
+        replaced = [point_id for point_id in ids if point_id in self._id_set]
+        if replaced:
+            self.delete(replaced)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+
+        self._pending_vectors.append(vectors.astype(self.dtype))
+
+        start = len(self._ids)
+        self._ids.extend(ids)
+        if self._id_set is None:
+            self._id_set = set(self._ids)
+        else:
+            self._id_set.update(ids)
+        self._hashes.extend(hashes if hashes is not None else [None] * len(ids))
+        for offset, document in enumerate(documents):
+            row = start + offset
+            self._payloads.append({"page_content": document.page_content,
+                                   "metadata": document.metadata})
+            for key, value in document.metadata.items():
+                if _is_scalar(value):
+                    self._metadata.setdefault(key, [None] * row)
+            for key, column in self._metadata.items():
+                value = document.metadata.get(key)
+                column.append(value if _is_scalar(value) else None)
+
+    def populate_vector_store(self, documents: List[Document], ids=None, hashes=None):
+        """
+        Populates the vector store with a list of documents (upserting by id).
+        """
+        if not documents:
+            print("No documents provided to populate.")
+            return
+
+        print(f"Adding {len(documents)} documents to the vector store...")
+        if ids == None:
+            ids = [str(uuid4()) for _ in range(len(documents))]
+        try:
+            vectors = self.embeddings.embed_documents([doc.page_content for doc in documents])
+            self.add_embeddings(ids, vectors, documents, hashes=hashes)
+            print(f"Successfully added {len(documents)} documents.")
+        except Exception as e:
+            print(f"Error adding documents: {e}")
+
+    def add_document(self, document: Document, id=None):
+        """
+        Adds a single document to the vector store.
+        """
+        print(f"Adding single document: '{document.page_content[:50]}...'")
+        if id == None:
+            id = str(uuid4())
+        self.populate_vector_store([document], ids=[id])
+
+    # ------------------------------------------------------------------ #
+    # reads
+    # ------------------------------------------------------------------ #
+
+    def index_metadata(self, keys=FILTER_KEYS):
+        """
+        Builds the inverted index (value -> row ids) of the given metadata keys.
+        Keys are otherwise indexed on their first filter; RAGmain.warmup indexes FILTER_KEYS.
+        """
+        for key in keys:
+            self._key_postings(key)
+
+    def _key_postings(self, key: str) -> Dict[Any, np.ndarray]:
+        postings = self._postings.get(key)
+        if postings is None:
+            rows: Dict[Any, List[int]] = {}
+            for row, value in enumerate(self._metadata.get(key, ())):
+                rows.setdefault(value, []).append(row)
+            postings = {value: np.asarray(ids, dtype=np.int64) for value, ids in rows.items()}
+            self._postings[key] = postings
+        return postings
+
+    def _match(self, key: str, value) -> Optional[np.ndarray]:
+        """
+        Sorted ids of the rows whose metadata ``key`` equals one of ``value``
+        (MatchValue/MatchAny semantics), from the inverted index: the cost depends
+        on the number of matches, not on the size of the store. None when the
+        condition is empty.
+        """
+        if value == None or len(value) == 0:
+            return None
+        postings = self._key_postings(key)
+        matches = [postings[v] for v in set(value) if v in postings]
+        if len(matches) == 1:
+            return matches[0]
+        if not matches:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(matches))
+
+    def _search_rows(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        # as in VectorStore.search, only 'luogo' is enforced (must), other keys are ignored
+        if not filters:
+            return None
+        rows = None
+        for key, value in filters.items():
+            if key != 'luogo' or value == None or len(value) == 0 or value[0] == 'None':
+                continue
+            condition = self._match(key, value)
+            rows = condition if rows is None else np.intersect1d(rows, condition, assume_unique=True)
+        return rows
+
+    def count(self, filters: Optional[Dict[str, Any]] = None) -> int:
+        """
+        Number of points ``search`` ranks with these filters, from the inverted index.
+        """
+        rows = self._search_rows(filters)
+        return len(self._ids) if rows is None else len(rows)
+
+    def _scores(self, query_vector: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        vectors = self._get_vectors()
+        n = len(self._ids) if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, SCORE_BLOCK_SIZE):
+            end = min(start + SCORE_BLOCK_SIZE, n)
+            block = vectors[start:end] if rows is None else vectors[rows[start:end]]
+            scores[start:end] = np.asarray(block, dtype=np.float32) @ query_vector
+        return scores
+
+    def _get_bm25(self) -> BM25Index:
+        if self._bm25 is None:
+            tokenizer = TOKENIZERS[self._bm25_tokenizer]
+            if self.path is not None and self._bm25_dir is not None:
+                self._bm25 = BM25Index.load(os.path.join(self.path, self._bm25_dir), tokenizer=tokenizer)
+            else:
+                # index saved without it (or modified since): build it from the payloads
+                self._bm25 = BM25Index([self._payloads[i]["page_content"] for i in range(len(self._ids))],
+                                       tokenizer=tokenizer)
+        return self._bm25
+
+    def _document(self, row: int) -> Document:
+        payload = self._payloads[row]
+        metadata = dict(payload.get("metadata") or {})
+        metadata["_id"] = self._ids[row]
+        metadata["_collection_name"] = self.collection_name
+        return Document(page_content=payload["page_content"], metadata=metadata)
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """
+        Normalized embedding of ``query``, to be passed to ``search`` as ``query_vector``.
+        """
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        return query_vector / max(float(np.linalg.norm(query_vector)), 1e-12)
+
+    def search(self, query: str, k: int = 2, filters: Optional[Dict[str, Any]] = None,
+               query_vector: Optional[np.ndarray] = None) -> List[Document]:
+        """
+        Performs a cosine similarity search in the vector store.
+
+        ``query_vector`` (from ``embed_query``) avoids embedding ``query`` again, e.g.
+        when a filtered search is repeated without filters. A filter matching no row
+        returns [] before any scoring.
+        """
+        if len(self._ids) == 0:
+            return []
+        try:
+            if query_vector is None:
+                query_vector = self.embed_query(query)
+
+            rows = self._search_rows(filters)
+            if rows is not None and len(rows) == 0:
+                return []
+
+            scores = self._scores(query_vector, rows)
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            documents = [self._document(int(row)) for row in (top if rows is None else rows[top])]
+            # cosine similarity, used by Retriever.rerank_adaptive to size the candidate set
+            for document, score in zip(documents, scores[top]):
+                document.metadata["_score"] = float(score)
+            return documents
+        except Exception as e:
+            print(f"Error during search: {e}")
+            return []
+
+    def lexical_search(self, query: str, k: int = 2, filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """
+        Performs a BM25 search over the page contents, with the filters of ``search``.
+        Only documents sharing at least one term with the query are returned.
+        """
+        if len(self._ids) == 0:
+            return []
+        try:
+            scores = self._get_bm25().get_scores(query)
+            rows = self._search_rows(filters)
+            rows = np.flatnonzero(scores > 0) if rows is None else rows[scores[rows] > 0]
+            if len(rows) == 0:
+                return []
+            k = min(k, len(rows))
+            top = rows[np.argpartition(-scores[rows], k - 1)[:k]]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            documents = [self._document(int(row)) for row in top]
+            for document, score in zip(documents, scores[top]):
+                document.metadata["_lexical_score"] = float(score)
+            return documents
+        except Exception as e:
+            print(f"Error during lexical search: {e}")
+            return []
+
+    def db_select(self, filters=None, limit=5000, offset=None, fields=None):
+        """
+        Returns the points matching any of the metadata filters (``should`` semantics),
+        as ``(records, next_offset)`` like ``QdrantClient.scroll``.
+
+        Args:
+            filters (Optional[Dict]): Metadata key -> accepted values.
+            limit (int): Maximum number of points of the page.
+            offset: ``next_offset`` of the previous page (None for the first page).
+            fields (Optional[List[str]]): Payload keys to return (None for the whole payload).
+        """
+        rows = None
+        if filters != None:
+            for key, value in filters.items():
+                condition = self._match(key, value)
+                if condition is None:
+                    continue
+                rows = condition if rows is None else np.union1d(rows, condition)
+        rows = range(len(self._ids)) if rows is None else rows
+        start = 0 if offset is None else int(offset)
+        end = start + limit
+        records = []
+        for row in rows[start:end]:
+            payload = self._payloads[int(row)]
+            if fields is not None:
+                payload = {field: payload[field] for field in fields if field in payload}
+            records.append(Record(id=self._ids[int(row)], payload=payload))
+        return records, (end if end < len(rows) else None)
+
+    def iter_select(self, filters=None, fields=None, limit=None, page_size=SELECT_PAGE_SIZE):
+        """
+        Yields the points of ``db_select`` one page at a time, fetching a page only
+        when the previous one has been consumed, up to ``limit`` points (None for all).
+        """
+        offset = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            records, offset = self.db_select(filters, limit=size, offset=offset, fields=fields)
+            yield from records
+            if remaining is not None:
+                remaining -= len(records)
+            if offset is None:
+                break
@@ -9,6 +9,11 @@ from qdrant_client import QdrantClient
 from qdrant_client.http.models import Distance, VectorParams, Filter, FieldCondition, MatchValue, MatchAny
 from langchain_core.documents import Document
 from typing import List, Dict, Optional, Any
+from .indexer import action_point_id
+from .cache import CachedEmbeddings
+
+# points fetched at a time by iter_select
+SELECT_PAGE_SIZE = 100
 
 class VectorStore:
     """
@@ -28,7 +33,7 @@ class VectorStore:
         """
         print(f"Initializing VectorStore with collection: '{collection_name}'...")
         self.collection_name = collection_name
-        self.embeddings = HuggingFaceEmbeddings(model_name=model_name)
+        self.embeddings = CachedEmbeddings(HuggingFaceEmbeddings(model_name=model_name), model_name)
         self.client = QdrantClient(":memory:")
         
         if vector_size == None:
@@ -62,7 +67,9 @@ class VectorStore:
 
         print(f"Adding {len(documents)} documents to the vector store...")
         if ids == None:
-            ids = [str(uuid4()) for _ in range(len(documents))]
+            # stable ids for actions, so that re-adding one overwrites it instead of duplicating it
+            ids = [action_point_id(doc.metadata["id"]) if "id" in doc.metadata else str(uuid4())
+                   for doc in documents]
         try:
             self.vector_store.add_documents(documents=documents, ids=ids)
             print(f"Successfully added {len(documents)} documents.")
@@ -82,9 +89,17 @@ class VectorStore:
         except Exception as e:
             print(f"Error adding document: {e}")
 
-    def search(self, query: str, k: int = 2, filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+    def embed_query(self, query: str) -> List[float]:
+        """
+        Embedding of ``query``, to be passed to ``search`` as ``query_vector``.
+        """
+        return self.embeddings.embed_query(query)
+
+    def search(self, query: str, k: int = 2, filters: Optional[Dict[str, Any]] = None,
+               query_vector: Optional[List[float]] = None) -> List[Document]:
         """
-        Performs a similarity search in the vector store.
+        Performs a similarity search in the vector store
+        (with ``query_vector`` the query is not embedded again).
         """
         # print(f"\nSearching for: '{query}' (k={k}) with filters: {filters}")
         qdrant_filter = None
@@ -118,11 +133,16 @@ class VectorStore:
 
 
         try:
-            results = self.vector_store.similarity_search(  
-                query=query,
-                k=k,
-                filter=qdrant_filter
-            )
+            if query_vector is None:
+                query_vector = self.embed_query(query)
+            results = []
+            for document, score in self.vector_store.similarity_search_with_score_by_vector(
+                    embedding=list(query_vector),
+                    k=k,
+                    filter=qdrant_filter):
+                # similarity score, used by Retriever.rerank_adaptive to size the candidate set
+                document.metadata["_score"] = score
+                results.append(document)
             # print(f"Found {len(results)} results.")
             return results
         except Exception as e:
@@ -130,7 +150,17 @@ class VectorStore:
             return []
 
 
-    def db_select(self, filters=None, limit=5000):
+    def db_select(self, filters=None, limit=5000, offset=None, fields=None):
+        """
+        Returns the points matching any of the metadata filters (``should`` semantics),
+        as ``(records, next_offset)``. Vectors are never returned.
+
+        Args:
+            filters (Optional[Dict]): Metadata key -> accepted values.
+            limit (int): Maximum number of points of the page.
+            offset: ``next_offset`` of the previous page (None for the first page).
+            fields (Optional[List[str]]): Payload keys to return (None for the whole payload).
+        """
         if filters != None:
             should_conditions = []
             for key, value in filters.items():
@@ -150,8 +180,27 @@ class VectorStore:
             qdrant_filter = Filter(should=should_conditions)
         else:
             qdrant_filter = None
-        results = self.client.scroll(self.collection_name, scroll_filter = qdrant_filter, limit=limit)
+        results = self.client.scroll(self.collection_name, scroll_filter = qdrant_filter, limit=limit,
+                                     offset=offset,
+                                     with_payload=True if fields is None else list(fields),
+                                     with_vectors=False)
         return results
+
+    def iter_select(self, filters=None, fields=None, limit=None, page_size=SELECT_PAGE_SIZE):
+        """
+        Yields the points of ``db_select`` one page at a time, fetching a page only
+        when the previous one has been consumed, up to ``limit`` points (None for all).
+        """
+        offset = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            records, offset = self.db_select(filters, limit=size, offset=offset, fields=fields)
+            yield from records
+            if remaining is not None:
+                remaining -= len(records)
+            if offset is None:
+                break
                 
 
 # --- Example Usage ---
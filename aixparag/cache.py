@@ -0,0 +1,487 @@
+"""
+Caches shared by the RAG pipeline.
+
+- LRUCache: bounded in-process mapping with LRU eviction, optional TTL and counters.
+- SQLiteStore: key-value table in a sqlite file, used as the on-disk tier.
+- ResponseCache: cache of LLM generations keyed by a normalized hash of the
+  prompt, model and temperature, with an optional embedding-similarity lookup.
+- EmbeddingCache: embeddings keyed by (model, normalized text hash), in memory
+  and optionally on disk as float16; CachedEmbeddings puts it under a model.
+- RerankScoreCache: cross-encoder scores keyed by (model, query hash, passage id).
+
+Caches are registered in ``_GLOBAL_CACHES`` so their counters can be reported.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .global_cache import _GLOBAL_CACHES
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe mapping bounded to ``maxsize`` entries, evicting the least recently
+    used one, with an optional time-to-live (seconds) and hit/miss/eviction counters.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[Any], None]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _evict(self, key):
+        del self._data[key]
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING or self._expired(item[1]):
+                if item is not _MISSING:
+                    self._evict(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.maxsize:
+                self._evict(next(iter(self._data)))
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            return item is not _MISSING and not self._expired(item[1])
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+class SQLiteStore:
+    """
+    Persistent key-value table in a sqlite file (WAL mode, so several worker
+    processes can share it). The connection is reopened after a fork.
+    """
+
+    def __init__(self, path: str, table: str = "cache", ttl: Optional[float] = None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                               "(key TEXT PRIMARY KEY, value BLOB, created_at REAL)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._connection().execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and time.time() - row[1] > self.ttl:
+            return None
+        return row[0]
+
+    def set(self, key: str, value):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                         (key, value, time.time()))
+            conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """
+        Values of the keys present (and not expired), in one query per 500 keys.
+        """
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = conn.execute(f"SELECT key, value, created_at FROM {self.table} "
+                                    f"WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                for key, value, created_at in rows:
+                    if self.ttl is None or time.time() - created_at <= self.ttl:
+                        found[key] = value
+        return found
+
+    def set_many(self, items: List[tuple]):
+        with self._lock:
+            conn = self._connection()
+            now = time.time()
+            conn.executemany(f"INSERT OR REPLACE INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                             [(key, value, now) for key, value in items])
+            conn.commit()
+
+    def purge_expired(self):
+        if self.ttl is None:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (time.time() - self.ttl,))
+            conn.commit()
+
+
+def normalize_text(text: str) -> str:
+    """
+    Lowercases and collapses whitespace, so trivially different prompts share a key.
+    """
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+class ResponseCache:
+    """
+    Cache of LLM responses for deterministic-enough calls (query rewriting, routing).
+
+    Entries are keyed by a hash of (model, temperature, max tokens, normalized
+    system prompt, normalized messages). Lookups go to the in-process LRU, then to
+    the optional sqlite file; if an ``embedder`` is given, a miss falls back to the
+    most similar cached prompt of the same model/system prompt when its cosine
+    similarity is at least ``similarity_threshold``.
+    """
+
+    def __init__(self,
+                 maxsize: int = 2048,
+                 ttl: Optional[float] = 24 * 3600,
+                 path: Optional[str] = None,
+                 embedder: Optional[Callable[[str], List[float]]] = None,
+                 similarity_threshold: float = 0.97):
+        """
+        Args:
+            maxsize (int): Maximum number of entries kept in memory.
+            ttl (Optional[float]): Seconds after which an entry expires (None: never).
+            path (Optional[str]): sqlite file for an on-disk tier surviving restarts.
+            embedder (Optional[Callable]): Function embedding a text, enables near-duplicate lookup.
+            similarity_threshold (float): Minimum cosine similarity for a near-duplicate hit.
+        """
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl, on_evict=self._forget_vector)
+        self.disk = SQLiteStore(path, table="responses", ttl=ttl) if path else None
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        # scope -> {key: normalized prompt vector}, for the similarity lookup
+        self._vectors: Dict[str, "OrderedDict[str, np.ndarray]"] = {}
+        self._vectors_lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0, "semantic": 0}
+        self.misses = 0
+
+    @staticmethod
+    def _scope(model_name: str, temperature: float, max_new_tokens: int, sys_prompt: str) -> str:
+        raw = json.dumps([model_name, temperature, max_new_tokens, normalize_text(sys_prompt)])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _key(scope: str, prompt: str) -> str:
+        return hashlib.sha256((scope + "\x00" + prompt).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _prompt(messages: List[str]) -> str:
+        return "\n".join(normalize_text(m) for m in messages)
+
+    def _forget_vector(self, key):
+        with self._vectors_lock:
+            for vectors in self._vectors.values():
+                vectors.pop(key, None)
+
+    def _embed(self, prompt: str) -> np.ndarray:
+        vector = np.asarray(self.embedder(prompt), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _similar(self, scope: str, vector: np.ndarray) -> Optional[str]:
+        with self._vectors_lock:
+            vectors = self._vectors.get(scope)
+            if not vectors:
+                return None
+            keys = list(vectors.keys())
+            matrix = np.stack(list(vectors.values()))
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] >= self.similarity_threshold:
+            return keys[best]
+        return None
+
+    def get(self, model_name: str, temperature: float, max_new_tokens: int,
+            sys_prompt: str, messages: List[str]) -> Optional[str]:
+        scope = self._scope(model_name, temperature, max_new_tokens, sys_prompt)
+        prompt = self._prompt(messages)
+        key = self._key(scope, prompt)
+
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits["memory"] += 1
+            return value
+
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.hits["disk"] += 1
+                self.memory.set(key, value)
+                return value
+
+        if self.embedder is not None:
+            similar_key = self._similar(scope, self._embed(prompt))
+            if similar_key is not None:
+                value = self.memory.get(similar_key)
+                if value is not None:
+                    self.hits["semantic"] += 1
+                    return value
+
+        self.misses += 1
+        return None
+
+    def set(self, model_name: str, temperature: float, max_new_tokens: int,
+            sys_prompt: str, messages: List[str], response: str):
+        scope = self._scope(model_name, temperature, max_new_tokens, sys_prompt)
+        prompt = self._prompt(messages)
+        key = self._key(scope, prompt)
+
+        self.memory.set(key, response)
+        if self.disk is not None:
+            self.disk.set(key, response)
+        if self.embedder is not None:
+            vector = self._embed(prompt)
+            with self._vectors_lock:
+                self._vectors.setdefault(scope, OrderedDict())[key] = vector
+
+    def stats(self) -> Dict[str, Any]:
+        total = sum(self.hits.values()) + self.misses
+        return {"size": len(self.memory),
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "evictions": self.memory.evictions,
+                "hit_rate": sum(self.hits.values()) / total if total else 0.0}
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by a hash of (model name, text with collapsed whitespace).
+
+    Vectors are kept as float32 in an in-process LRU and, if ``path`` is given, as
+    float16 in a sqlite file shared by processes and runs (ingestion, API workers).
+    """
+
+    def __init__(self, maxsize: int = 20000, path: Optional[str] = None):
+        """
+        Args:
+            maxsize (int): Maximum number of vectors kept in memory.
+            path (Optional[str]): sqlite file for the on-disk tier.
+        """
+        self.memory = LRUCache(maxsize=maxsize)
+        self.disk = SQLiteStore(path, table="embeddings") if path else None
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        # whitespace only: case and accents can change the embedding
+        normalized = re.sub(r"\s+", " ", text.strip())
+        return hashlib.sha256((model_name + "\x00" + normalized).encode("utf-8")).hexdigest()
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        The cached vector of each text, None where missing.
+        """
+        keys = [self.key(model_name, text) for text in texts]
+        vectors = [self.memory.get(key) for key in keys]
+        missing = [key for key, vector in zip(keys, vectors) if vector is None]
+        if self.disk is not None and missing:
+            found = self.disk.get_many(list(set(missing)))
+            for i, key in enumerate(keys):
+                if vectors[i] is None and key in found:
+                    vectors[i] = np.frombuffer(found[key], dtype=np.float16).astype(np.float32)
+                    self.memory.set(key, vectors[i])
+                    self.hits["disk"] += 1
+        found_in_memory = len(keys) - len(missing)
+        self.hits["memory"] += found_in_memory
+        self.misses += sum(vector is None for vector in vectors)
+        return vectors
+
+    def set_many(self, model_name: str, texts: List[str], vectors):
+        keys = [self.key(model_name, text) for text in texts]
+        vectors = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+        for key, vector in zip(keys, vectors):
+            self.memory.set(key, vector)
+        if self.disk is not None:
+            self.disk.set_many([(key, vector.astype(np.float16).tobytes()) for key, vector in zip(keys, vectors)])
+
+    def stats(self) -> Dict[str, Any]:
+        total = sum(self.hits.values()) + self.misses
+        return {"size": len(self.memory),
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "evictions": self.memory.evictions,
+                "hit_rate": sum(self.hits.values()) / total if total else 0.0}
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedding model wrapper that only embeds the texts missing from the embedding
+    cache (``get_embedding_cache()`` unless a cache is given).
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: Optional[EmbeddingCache] = None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self._cache = cache
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache if self._cache is not None else get_embedding_cache()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [vector.tolist() for vector in embed_with_cache(self.model_name, texts,
+                                                               self.embeddings.embed_documents, self.cache)]
+
+    def embed_query(self, text: str) -> List[float]:
+        # queries may be embedded differently (instructions, prompts): own key space
+        return embed_with_cache(self.model_name + "#query", [text],
+                                lambda texts: [self.embeddings.embed_query(texts[0])], self.cache)[0].tolist()
+
+
+def embed_with_cache(model_name: str, texts: List[str],
+                     embed: Callable[[List[str]], Any],
+                     cache: Optional[EmbeddingCache] = None) -> List[np.ndarray]:
+    """
+    Vectors of ``texts``: cached ones are reused, the others are computed with
+    ``embed`` (called once, on the missing texts) and added to the cache.
+    """
+    cache = cache if cache is not None else get_embedding_cache()
+    vectors = cache.get_many(model_name, texts)
+    # one text per missing key: texts differing only by whitespace are embedded once
+    missing = {}
+    for text, vector in zip(texts, vectors):
+        if vector is None:
+            missing.setdefault(cache.key(model_name, text), text)
+    if missing:
+        embedded = [np.asarray(vector, dtype=np.float32) for vector in embed(list(missing.values()))]
+        cache.set_many(model_name, list(missing.values()), embedded)
+        lookup = dict(zip(missing.keys(), embedded))
+        vectors = [vector if vector is not None else lookup[cache.key(model_name, text)]
+                   for text, vector in zip(texts, vectors)]
+    return vectors
+
+
+def configure_embedding_cache(**kwargs) -> EmbeddingCache:
+    """
+    Creates the process-wide embedding cache (see EmbeddingCache for the arguments).
+    """
+    _GLOBAL_CACHES["embeddings"] = EmbeddingCache(**kwargs)
+    return _GLOBAL_CACHES["embeddings"]
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    # in memory only unless configured
+    if "embeddings" not in _GLOBAL_CACHES:
+        configure_embedding_cache()
+    return _GLOBAL_CACHES["embeddings"]
+
+
+class RerankScoreCache:
+    """
+    Cross-encoder scores of (query, passage) pairs, in a bounded LRU keyed by
+    (reranker model, hash of the query, passage id), so that repeated or retried
+    turns only score the passages not seen with that query.
+    """
+
+    def __init__(self, maxsize: int = 50000, ttl: Optional[float] = None):
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def query_hash(query: str) -> str:
+        return hashlib.sha256(re.sub(r"\s+", " ", query.strip()).encode("utf-8")).hexdigest()
+
+    def get_many(self, model_name: str, query: str, passage_ids: List[str]) -> List[Optional[float]]:
+        query_hash = self.query_hash(query)
+        return [self.memory.get((model_name, query_hash, passage_id)) for passage_id in passage_ids]
+
+    def set_many(self, model_name: str, query: str, passage_ids: List[str], scores: List[float]):
+        query_hash = self.query_hash(query)
+        for passage_id, score in zip(passage_ids, scores):
+            self.memory.set((model_name, query_hash, passage_id), float(score))
+
+    def stats(self) -> Dict[str, Any]:
+        return self.memory.stats()
+
+
+def configure_rerank_cache(maxsize: int = 50000, ttl: Optional[float] = None) -> Optional[RerankScoreCache]:
+    """
+    Creates the process-wide rerank score cache; maxsize 0 disables it.
+    """
+    _GLOBAL_CACHES["rerank_scores"] = RerankScoreCache(maxsize=maxsize, ttl=ttl) if maxsize > 0 else None
+    return _GLOBAL_CACHES["rerank_scores"]
+
+
+def get_rerank_cache() -> Optional[RerankScoreCache]:
+    if "rerank_scores" not in _GLOBAL_CACHES:
+        configure_rerank_cache()
+    return _GLOBAL_CACHES["rerank_scores"]
+
+
+def configure_response_cache(**kwargs) -> ResponseCache:
+    """
+    Creates the process-wide response cache used by utils.expand_query and utils.sql_planner.
+    """
+    _GLOBAL_CACHES["response"] = ResponseCache(**kwargs)
+    return _GLOBAL_CACHES["response"]
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    return _GLOBAL_CACHES.get("response")
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Counters of every registered cache.
+    """
+    return {name: cache.stats() for name, cache in _GLOBAL_CACHES.items() if cache is not None}
@@ -0,0 +1,102 @@
+"""
+OpenAI-compatible clients shared across requests.
+
+start_api calls ``configure_clients`` once at startup; afterwards every
+model and endpoint takes its client from here, so HTTP connections (and
+TLS sessions) are pooled and kept alive instead of being opened per request.
+"""
+
+import os
+from dataclasses import dataclass
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+from .global_cache import _GLOBAL_CLIENTS
+
+DEFAULT_POOL_SIZE = 100
+DEFAULT_TIMEOUT = 120.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+
+
+@dataclass
+class ClientSettings:
+    base_url: str
+    api_key: str
+    model: str
+    base_model: str
+    pool_size: int = DEFAULT_POOL_SIZE
+    timeout: float = DEFAULT_TIMEOUT
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.pool_size,
+                            max_keepalive_connections=self.pool_size,
+                            keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY)
+
+    def timeouts(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+
+def configure_clients(base_url: str, api_key: str, model: str, base_model: str,
+                      pool_size: int = DEFAULT_POOL_SIZE,
+                      timeout: float = DEFAULT_TIMEOUT,
+                      connect_timeout: float = DEFAULT_CONNECT_TIMEOUT) -> ClientSettings:
+    """
+    Sets the server settings and pool sizes; clients are (re)created on first use.
+
+    Args:
+        base_url (str): Endpoint of the OpenAI-compatible server.
+        api_key (str): API key for the server.
+        model (str): Model used for the chatbot answers.
+        base_model (str): Model used for query rewriting, routing and metadata extraction.
+        pool_size (int): Maximum number of (kept-alive) connections per process.
+        timeout (float): Read/write timeout of a request, in seconds.
+        connect_timeout (float): Connection timeout, in seconds.
+    """
+    _GLOBAL_CLIENTS.clear()
+    _GLOBAL_CLIENTS["settings"] = ClientSettings(base_url, api_key, model, base_model,
+                                                 pool_size, timeout, connect_timeout)
+    return _GLOBAL_CLIENTS["settings"]
+
+
+def get_settings() -> ClientSettings:
+    if "settings" not in _GLOBAL_CLIENTS:
+        # not configured (e.g. modules used outside the API): take start_api's arguments
+        from start_api import start_api_openai_base_url, start_api_openai_key, start_api_openai_model, start_api_openai_base_model
+        configure_clients(start_api_openai_base_url, start_api_openai_key,
+                          start_api_openai_model, start_api_openai_base_model)
+    return _GLOBAL_CLIENTS["settings"]
+
+
+def _get_client(name, factory):
+    # clients are per process: a forked worker must not reuse the parent's connections
+    key = (name, os.getpid())
+    if key not in _GLOBAL_CLIENTS:
+        _GLOBAL_CLIENTS[key] = factory(get_settings())
+    return _GLOBAL_CLIENTS[key]
+
+
+def get_openai_client() -> OpenAI:
+    """
+    Shared synchronous client, with a keep-alive connection pool.
+    """
+    return _get_client("openai", lambda settings: OpenAI(
+        base_url=settings.base_url,
+        api_key=settings.api_key,
+        timeout=settings.timeouts(),
+        http_client=httpx.Client(limits=settings.limits(), timeout=settings.timeouts()),
+    ))
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """
+    Shared asyncio client, with a keep-alive connection pool.
+    """
+    return _get_client("async_openai", lambda settings: AsyncOpenAI(
+        base_url=settings.base_url,
+        api_key=settings.api_key,
+        timeout=settings.timeouts(),
+        http_client=httpx.AsyncClient(limits=settings.limits(), timeout=settings.timeouts()),
+    ))
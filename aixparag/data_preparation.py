@@ -4,6 +4,7 @@ import collections
 import re
 import os
 from .global_cache import _GLOBAL_AMBITI, _GLOBAL_TASSONOMIE
+from .gazetteer import reset_gazetteer
 
 # def chunking(data_dict, metadata=False):
 #     chunked_data = collections.defaultdict(lambda : 'Key Not Found')
@@ -183,6 +184,13 @@ def chunking(data_dict, metadata=False):
 # dialog_documents = list(set(dialog_documents)) # removing duplicates
 
 def extract_metadata(doclist):
+    """
+    Chunks the documents into actions with metadata and saves them to aixparag/data.
+
+    Args:
+        doclist (list[str] | dict[str, str]): The document texts, or a mapping from
+                                              a stable document id to its text.
+    """
     print("Extracting metadata from documents...")
     os.makedirs("aixparag/data", exist_ok=True)
     # getting documents
@@ -191,8 +199,10 @@ def extract_metadata(doclist):
     #     with open(f"data/files/{el}", "r", encoding='utf8') as file:
     #         data[el] = file.read()
 
-    for i, el in enumerate(doclist):
-        data[str(i)] = el
+    # a dict (e.g. file name -> text) keeps action ids stable when documents are added or removed
+    items = doclist.items() if isinstance(doclist, dict) else enumerate(doclist)
+    for doc_id, el in items:
+        data[str(doc_id)] = el
 
     # chunking
     chunked_data = chunking(data, metadata=True)
@@ -283,6 +293,8 @@ def extract_metadata(doclist):
     with open("aixparag/data/cities.txt", "w") as file:
         for a in sorted(list(all_cities)):
             file.write(f"{a}\n")
+    # the gazetteer is compiled again from the new list on its next use
+    reset_gazetteer()
 
     # print(_GLOBAL_TASSONOMIE)
 
@@ -302,3 +314,31 @@ def extract_metadata(doclist):
     print("\n--- Unique MACRO-AMBITO ---")
     for a in sorted(list(all_ambiti)):
         print(f"- {a}")
+
+
+def load_metadata_cache(path="aixparag/data/data_and_metadata.json"):
+    """
+    Fills _GLOBAL_TASSONOMIE and _GLOBAL_AMBITI from a previously saved
+    data_and_metadata.json, for processes that load an existing vector store
+    instead of running extract_metadata.
+    """
+    if not os.path.exists(path):
+        print(f"Warning: '{path}' not found, metadata cache left empty.")
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        chunked_data = json.load(f)
+
+    _GLOBAL_TASSONOMIE.clear()
+    _GLOBAL_AMBITI.clear()
+    for doc_id, doc_info in chunked_data.items():
+        city = doc_info.get("place", "").lower()
+        _GLOBAL_TASSONOMIE.setdefault(city, [])
+        _GLOBAL_AMBITI.setdefault(city, [])
+        for action_metadata in doc_info.get("actions_metadata", []):
+            tassonomia = action_metadata.get("tassonomia")
+            if tassonomia:
+                _GLOBAL_TASSONOMIE[city].append(tassonomia.lower())
+            ambito = action_metadata.get("macro-ambito")
+            if ambito:
+                _GLOBAL_AMBITI[city].append(ambito.lower())
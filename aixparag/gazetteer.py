@@ -0,0 +1,119 @@
+"""
+City gazetteer: detects the municipalities named in the first line of the documents.
+
+The city list (``aixparag/data/cities.txt``, written by
+``data_preparation.extract_metadata``) is read once and compiled into an
+Aho-Corasick automaton over the patterns ``" <city> "`` (lowercase), so each
+first line is scanned once for all the cities instead of once per city.
+Each gazetteer memoizes its results by first-line hash, as clients send the
+same ``documents_list`` at every turn.
+"""
+
+import hashlib
+from typing import List, Tuple
+
+from .cache import LRUCache
+from .global_cache import _GLOBAL_CACHES, _GLOBAL_GAZETTEER
+
+CITIES_PATH = "aixparag/data/cities.txt"
+# first lines whose cities each gazetteer remembers
+MEMO_SIZE = 4096
+
+
+class Gazetteer:
+    """
+    Aho-Corasick automaton over the lowercase city names, each padded with one space
+    on both sides (a city matches only as a whole, space-delimited, phrase).
+    """
+
+    def __init__(self, cities: List[str], memo_size: int = MEMO_SIZE):
+        """
+        Args:
+            cities (List[str]): City names; matches are reported in this order.
+            memo_size (int): First lines whose cities are memoized.
+        """
+        self.cities = [city.lower() for city in cities]
+        # cities found per first line, by sha256 of the line (valid for this city list only)
+        self.memo = LRUCache(maxsize=memo_size)
+        # trie: transitions, failure link and ids of the patterns ending at each node
+        self._goto = [{}]
+        self._fail = [0]
+        self._output: List[List[int]] = [[]]
+        for pattern_id, city in enumerate(self.cities):
+            node = 0
+            for char in " " + city + " ":
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = next_node
+            self._output[node].append(pattern_id)
+
+        # failure links, breadth first; outputs of the failure node are merged in
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    @classmethod
+    def from_file(cls, path: str = CITIES_PATH) -> "Gazetteer":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls([line.strip() for line in f if line.strip()])
+
+    def _match(self, text: str) -> List[int]:
+        # ids of the patterns occurring in text (overlapping occurrences included)
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            found.update(self._output[node])
+        return sorted(found)
+
+    def find(self, line: str) -> Tuple[str, ...]:
+        """
+        Cities named in ``line``, once each, in the order of the city list.
+        """
+        return tuple(self.cities[pattern_id] for pattern_id in self._match(line.lower()))
+
+    def find_in_first_lines(self, documents: List[str]) -> List[str]:
+        """
+        Cities named in the first line of each document, document after document.
+        """
+        found_cities = []
+        for doc in documents:
+            first_line = doc.splitlines()[0] if doc else ""
+            key = hashlib.sha256(first_line.encode("utf-8")).hexdigest()
+            cities = self.memo.get(key)
+            if cities is None:
+                cities = self.find(first_line)
+                self.memo.set(key, cities)
+            found_cities.extend(cities)
+        return found_cities
+
+
+def get_gazetteer() -> Gazetteer:
+    """
+    Gazetteer of the current city list, compiled on first use.
+    """
+    if "default" not in _GLOBAL_GAZETTEER:
+        _GLOBAL_GAZETTEER["default"] = Gazetteer.from_file()
+        _GLOBAL_CACHES["gazetteer"] = _GLOBAL_GAZETTEER["default"].memo
+    return _GLOBAL_GAZETTEER["default"]
+
+
+def reset_gazetteer():
+    """
+    Drops the compiled gazetteer (and so its memoized results), after the city list has been rewritten.
+    """
+    _GLOBAL_GAZETTEER.clear()
+    _GLOBAL_CACHES.pop("gazetteer", None)
@@ -3,4 +3,8 @@ _GLOBAL_RERANKERS = {}
 _GLOBAL_AMBITI = {}
 _GLOBAL_TASSONOMIE = {}
 _GLOBAL_EMBEDDINGS = {}
-_GLOBAL_VECTOR_STORE = {}
\ No newline at end of file
+_GLOBAL_VECTOR_STORE = {}
+_GLOBAL_CACHES = {}
+_GLOBAL_CLIENTS = {}
+_GLOBAL_RETRIEVERS = {}
+_GLOBAL_GAZETTEER = {}
\ No newline at end of file
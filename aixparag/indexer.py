@@ -0,0 +1,109 @@
+"""
+Incremental indexing of the actions produced by data_preparation.chunking.
+
+Every action becomes one point whose id is derived from its ``action_id`` and
+whose content hash is stored next to the vector, so that re-indexing only
+embeds new or changed actions and deletes the ones that disappeared.
+"""
+
+import hashlib
+import json
+from typing import Dict, List, Optional
+from uuid import NAMESPACE_URL, uuid5
+
+from langchain_core.documents import Document
+
+from .ingestion import DEFAULT_BATCH_SIZE, ingest_documents
+
+# namespace of the point ids, so the same action_id always maps to the same id
+ACTION_ID_NAMESPACE = uuid5(NAMESPACE_URL, "aixparag/actions")
+# metadata MmapVectorStore filters on (search on luogo, db_select on all of them), indexed at warmup
+FILTER_KEYS = ("luogo", "tassonomia", "macro_ambito")
+
+
+def action_point_id(action_id: str) -> str:
+    """
+    Stable point id (a UUID, as required by qdrant) for an action_id.
+    """
+    return str(uuid5(ACTION_ID_NAMESPACE, action_id))
+
+
+def content_hash(document: Document) -> str:
+    """
+    Hash of the text and metadata of a document: it changes whenever the point would.
+    """
+    h = hashlib.sha256()
+    h.update(document.page_content.encode("utf-8"))
+    h.update(json.dumps(document.metadata, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+def build_documents(data: Dict) -> List[Document]:
+    """
+    Converts the chunked data (data_and_metadata.json) into one Document per action.
+    """
+    documents = []
+    for doc_id, item in data.items():
+        actions = [Document(page_content =  f"COMUNE DI: {item['place']}\n" + action['action_text'],
+                            metadata = {"tassonomia": metadata['tassonomia'].lower(),
+                                        "macro_ambito": metadata['macro-ambito'],
+                                        "luogo": item['place'].lower(),
+                                        "id": action['action_id']})
+                            for action,metadata in zip(item['actions'], item['actions_metadata'])]
+        documents.extend(actions)
+    return documents
+
+
+def sync_vector_store(vector_store, documents: List[Document],
+                      batch_size: int = DEFAULT_BATCH_SIZE,
+                      num_workers: int = 1,
+                      checkpoint_path: Optional[str] = None) -> Dict[str, int]:
+    """
+    Brings the vector store in line with ``documents``: only new or changed
+    actions are embedded and upserted, actions no longer present are deleted.
+
+    Args:
+        vector_store: A store exposing ``content_hashes``, ``add_embeddings``
+                      and ``delete``, e.g. MmapVectorStore.
+        documents (List[Document]): The actions, each with its ``id`` metadata.
+        batch_size (int): Embedding batch size.
+        num_workers (int): Number of embedding processes.
+        checkpoint_path (Optional[str]): Where to save the store periodically while
+                                         embedding, so an interrupted run can resume.
+
+    Returns:
+        Dict[str, int]: Number of added, updated, deleted and unchanged points.
+    """
+    current = vector_store.content_hashes()
+
+    wanted = {}
+    for document in documents:
+        wanted[action_point_id(document.metadata["id"])] = (document, content_hash(document))
+
+    to_embed, ids, hashes = [], [], []
+    added = updated = 0
+    for point_id, (document, digest) in wanted.items():
+        if point_id not in current:
+            added += 1
+        elif current[point_id] != digest:
+            updated += 1
+        else:
+            continue
+        to_embed.append(document)
+        ids.append(point_id)
+        hashes.append(digest)
+
+    removed = [point_id for point_id in current if point_id not in wanted]
+    if removed:
+        vector_store.delete(removed)
+    if to_embed:
+        ingest_documents(vector_store, to_embed, ids, hashes=hashes,
+                         batch_size=batch_size, num_workers=num_workers,
+                         checkpoint_path=checkpoint_path)
+
+    stats = {"added": added,
+             "updated": updated,
+             "deleted": len(removed),
+             "unchanged": len(wanted) - added - updated}
+    print(f"Vector store sync: {stats}")
+    return stats
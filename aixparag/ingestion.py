@@ -0,0 +1,165 @@
+"""
+Batched, multi-process embedding of the corpus.
+
+Texts are sorted by length and cut into batches, so each batch pads to a
+similar sequence length; batches are embedded by a pool of processes (each
+with its own copy of the model and a share of the CPU threads) and streamed
+into the vector store as soon as they finish. Texts found in the embedding
+cache are not embedded again, and new embeddings are added to it.
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from .cache import get_embedding_cache
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 64
+# save the index every N batches, so an interrupted run resumes from there
+DEFAULT_CHECKPOINT_EVERY = 20
+# and only once the store has grown by this fraction since the last save: every save
+# rewrites the whole store, so geometric spacing keeps the total writes linear
+CHECKPOINT_GROWTH = 0.25
+
+# embedding model of a pool worker, set by _init_worker
+_WORKER_EMBEDDINGS = None
+
+
+def _init_worker(model_name: str, num_threads: int, batch_size: int):
+    global _WORKER_EMBEDDINGS
+    import torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    torch.set_num_threads(num_threads)
+    _WORKER_EMBEDDINGS = HuggingFaceEmbeddings(model_name=model_name,
+                                               encode_kwargs={"batch_size": batch_size})
+
+
+def _embed_batch(indices: List[int], texts: List[str]) -> Tuple[List[int], np.ndarray]:
+    return indices, np.asarray(_WORKER_EMBEDDINGS.embed_documents(texts), dtype=np.float32)
+
+
+def make_batches(texts: List[str], batch_size: int) -> List[List[int]]:
+    """
+    Groups text indices into batches of similar length (character length is used
+    as a cheap proxy of the token length), to reduce padding inside each batch.
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def iter_embedded_batches(texts: List[str],
+                          model_name: str,
+                          batch_size: int = DEFAULT_BATCH_SIZE,
+                          num_workers: int = 1) -> Iterator[Tuple[List[int], np.ndarray]]:
+    """
+    Embeds ``texts`` and yields ``(indices, vectors)`` for each batch as it completes
+    (not necessarily in input order), logging the throughput in docs/sec.
+
+    Args:
+        texts (List[str]): Texts to embed.
+        model_name (str): HuggingFace embedding model.
+        batch_size (int): Number of texts per batch.
+        num_workers (int): Number of embedding processes; 1 embeds in this process.
+    """
+    batches = make_batches(texts, batch_size)
+    total = len(texts)
+    done = 0
+    start = time.perf_counter()
+
+    def report():
+        elapsed = time.perf_counter() - start
+        logger.info(f"Embedded {done}/{total} docs ({done / max(elapsed, 1e-9):.1f} docs/sec)")
+
+    if num_workers <= 1:
+        from .VectorStoreMmap import get_embeddings
+        # the bare model: ingest_documents does the cache lookups itself
+        embeddings = get_embeddings(model_name).embeddings
+        for indices in batches:
+            vectors = np.asarray(embeddings.embed_documents([texts[i] for i in indices]), dtype=np.float32)
+            done += len(indices)
+            report()
+            yield indices, vectors
+        return
+
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    # spawn: forking a process that already initialized torch threads can deadlock
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(model_name, num_threads, batch_size)) as pool:
+        futures = [pool.submit(_embed_batch, indices, [texts[i] for i in indices]) for indices in batches]
+        for future in as_completed(futures):
+            indices, vectors = future.result()
+            done += len(indices)
+            report()
+            yield indices, vectors
+
+
+def ingest_documents(vector_store,
+                     documents: List[Document],
+                     ids: List[str],
+                     hashes: Optional[List[str]] = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE,
+                     num_workers: int = 1,
+                     checkpoint_path: Optional[str] = None,
+                     checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY) -> Dict[str, float]:
+    """
+    Embeds ``documents`` in batches and streams them into ``vector_store``.
+
+    When ``checkpoint_path`` is given the store is saved there every
+    ``checkpoint_every`` batches, provided it grew by CHECKPOINT_GROWTH since the
+    previous save; together with the content hashes this lets an interrupted
+    ingestion resume, since sync_vector_store skips what is stored.
+
+    Returns:
+        Dict[str, float]: Number of documents, elapsed seconds and docs/sec.
+    """
+    start = time.perf_counter()
+    texts = [doc.page_content for doc in documents]
+    cache = get_embedding_cache()
+    model_name = vector_store.model_name
+
+    def add(indices, vectors):
+        vector_store.add_embeddings([ids[i] for i in indices],
+                                    vectors,
+                                    [documents[i] for i in indices],
+                                    hashes=[hashes[i] for i in indices] if hashes is not None else None)
+
+    cached = cache.get_many(model_name, texts)
+    hit = [i for i, vector in enumerate(cached) if vector is not None]
+    if hit:
+        logger.info(f"{len(hit)}/{len(texts)} embeddings found in the cache")
+        add(hit, np.stack([cached[i] for i in hit]))
+    missing = [i for i, vector in enumerate(cached) if vector is None]
+
+    batches_done = 0
+    saved_size = len(vector_store)
+    batches = iter_embedded_batches([texts[i] for i in missing], model_name,
+                                    batch_size=batch_size, num_workers=num_workers) if missing else []
+    for batch, vectors in batches:
+        indices = [missing[i] for i in batch]
+        cache.set_many(model_name, [texts[i] for i in indices], vectors)
+        add(indices, vectors)
+        batches_done += 1
+        if (checkpoint_path and batches_done % checkpoint_every == 0
+                and len(vector_store) - saved_size >= CHECKPOINT_GROWTH * saved_size):
+            # the final save of the caller builds the lexical index
+            vector_store.save(checkpoint_path, checkpoint=True)
+            saved_size = len(vector_store)
+
+    elapsed = time.perf_counter() - start
+    stats = {"documents": len(documents),
+             "seconds": elapsed,
+             "docs_per_sec": len(documents) / max(elapsed, 1e-9)}
+    logger.info(f"Ingested {len(documents)} documents in {elapsed:.1f}s ({stats['docs_per_sec']:.1f} docs/sec)")
+    return stats
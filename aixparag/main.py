@@ -95,8 +95,8 @@ while query.lower() != "exit":
             router = utils.sql_planner(hf_model, query)
             if router == "DB_QUERY":
                 print("--> DB_QUERY")
-                search_results = my_vector_store.db_select(filters=response_dict, limit=5)
-                context ="\n\n".join([el.payload['page_content'] for el in search_results[0]])
+                search_results = my_vector_store.iter_select(filters=response_dict, fields=["page_content"], limit=5)
+                context ="\n\n".join([el.payload['page_content'] for el in search_results])
                 reply = utils.rag_reply_hf(hf_model, query, conversation, context)
                 conversation.append(reply)
                 print(f"\n\n>>> ChatBot: {reply}\n\n")
@@ -7,6 +7,7 @@ from guidance import system, user, assistant
 from pydantic import BaseModel, field_validator
 from typing import Optional
 from .LanguageModel import VLLMModel
+from .cache import get_response_cache
 
 class MessageInfo(BaseModel):
     tassonomia: list[str]
@@ -78,7 +79,7 @@ def get_similarity(list1, list2):
                 similar_items.append(or_el)
     return list(set(similar_items))
 
-def exctract_metadata(model, query, conversation, tassonomie, ambiti, luoghi):
+def _metadata_prompt(query, tassonomie, ambiti, luoghi):
     tassonomie_text = "\n".join([f"- {el}" for el in tassonomie])
     ambiti_text = "\n".join([f"- {el}" for el in ambiti])
     luoghi_text = "\n".join([f"- {el}" for el in luoghi])
@@ -90,12 +91,12 @@ def exctract_metadata(model, query, conversation, tassonomie, ambiti, luoghi):
     conv = []
     conv.append(query)
 
-    user_prompt = prompts.METADATA_USER_2.format(tassonomie = tassonomie_text,
-                                                macro_ambiti = ambiti_text,
-                                                location = luoghi_text,
-                                                conversation = conv)
-    
-    response = model.generate_json(prompts.METADATA_SYS, [user_prompt], temperature=0.9, max_new_tokens=500)
+    return prompts.METADATA_USER_2.format(tassonomie = tassonomie_text,
+                                          macro_ambiti = ambiti_text,
+                                          location = luoghi_text,
+                                          conversation = conv)
+
+def _postprocess_metadata(response, tassonomie, ambiti):
     # postprocessing json
     loaded_json = json.loads(response)
     if 'tassonomia' in loaded_json and len(loaded_json['tassonomia']) > 0:
@@ -109,7 +110,63 @@ def exctract_metadata(model, query, conversation, tassonomie, ambiti, luoghi):
             loaded_json['luogo'] = [el.lower() for el in loaded_json['luogo']]
     return loaded_json 
 
+def exctract_metadata(model, query, conversation, tassonomie, ambiti, luoghi):
+    user_prompt = _metadata_prompt(query, tassonomie, ambiti, luoghi)
+    response = model.generate_json(prompts.METADATA_SYS, [user_prompt], temperature=0.9, max_new_tokens=500)
+    return _postprocess_metadata(response, tassonomie, ambiti)
+
+async def exctract_metadata_async(model, query, conversation, tassonomie, ambiti, luoghi):
+    """
+    Same as exctract_metadata, with an AsyncVLLMModel.
+    """
+    user_prompt = _metadata_prompt(query, tassonomie, ambiti, luoghi)
+    response = await model.generate_json(prompts.METADATA_SYS, [user_prompt], temperature=0.9, max_new_tokens=500)
+    return _postprocess_metadata(response, tassonomie, ambiti)
+
+
 
+def _is_error_reply(reply) -> bool:
+    # VLLMModel reports failures as text, those must not be cached
+    return reply is None or reply.startswith("Error:") or reply.startswith("An error occurred")
+
+def cached_generate(model, sys_prompt: str, messages: list, max_new_tokens: int = 500, temperature: float = 0.9) -> str:
+    """
+    model.generate through the response cache configured with configure_response_cache (if any).
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return model.generate(sys_prompt, messages, max_new_tokens=max_new_tokens, temperature=temperature)
+    reply = cache.get(model.model_name, temperature, max_new_tokens, sys_prompt, messages)
+    if reply is None:
+        reply = model.generate(sys_prompt, messages, max_new_tokens=max_new_tokens, temperature=temperature)
+        if not _is_error_reply(reply):
+            cache.set(model.model_name, temperature, max_new_tokens, sys_prompt, messages, reply)
+    return reply
+
+async def cached_generate_async(model, sys_prompt: str, messages: list, max_new_tokens: int = 500, temperature: float = 0.9) -> str:
+    """
+    Same as cached_generate, with an AsyncVLLMModel.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return await model.generate(sys_prompt, messages, max_new_tokens=max_new_tokens, temperature=temperature)
+    reply = cache.get(model.model_name, temperature, max_new_tokens, sys_prompt, messages)
+    if reply is None:
+        reply = await model.generate(sys_prompt, messages, max_new_tokens=max_new_tokens, temperature=temperature)
+        if not _is_error_reply(reply):
+            cache.set(model.model_name, temperature, max_new_tokens, sys_prompt, messages, reply)
+    return reply
+
+def _expand_query_prompt(conversation: list) -> str:
+    last_turn = conversation[-1]
+    context_turns = conversation[:-1]
+    return prompts.QUERY_RWR_USER.format(conversation=context_turns,
+                                         query=last_turn)
+
+def _clean_rewritten_query(rewritten_query: str) -> str:
+    rewritten_query = rewritten_query.strip()
+    rewritten_query = rewritten_query.replace("<REWRITTEN_QUERY>", "").replace("</REWRITTEN_QUERY>", "")
+    return rewritten_query.strip()
 
 def expand_query(model, conversation: list) -> str:
     """
@@ -126,27 +183,41 @@ def expand_query(model, conversation: list) -> str:
     if not conversation:
         return "Error: The conversation list cannot be empty."
 
-   
-    last_turn = conversation[-1]
-    context_turns = conversation[:-1]
-
     sys_prompt = prompts.QUERY_RWR_SYS
-    user_prompt = prompts.QUERY_RWR_USER.format(conversation=context_turns,
-                                                query=last_turn)
-    
-
-    messages = [user_prompt]
+    messages = [_expand_query_prompt(conversation)]
     try:
         # Call the VLLMModel's generate function
-        rewritten_query = model.generate(
+        rewritten_query = cached_generate(
+            model,
+            sys_prompt=sys_prompt,
+            messages=messages,
+            max_new_tokens=200,
+            temperature=0.4
+        )
+        return _clean_rewritten_query(rewritten_query)
+
+    except Exception as e:
+        print(f"Error during query rewriting: {e}")
+        return "An error occurred while rewriting the query."
+
+async def expand_query_async(model, conversation: list) -> str:
+    """
+    Same as expand_query, with an AsyncVLLMModel.
+    """
+    if not conversation:
+        return "Error: The conversation list cannot be empty."
+
+    sys_prompt = prompts.QUERY_RWR_SYS
+    messages = [_expand_query_prompt(conversation)]
+    try:
+        rewritten_query = await cached_generate_async(
+            model,
             sys_prompt=sys_prompt,
-            conversation=messages,
+            messages=messages,
             max_new_tokens=200,
             temperature=0.4
-        ).strip()
-        rewritten_query = rewritten_query.replace("<REWRITTEN_QUERY>", "").replace("</REWRITTEN_QUERY>", "")
-        rewritten_query = rewritten_query.strip()
-        return rewritten_query
+        )
+        return _clean_rewritten_query(rewritten_query)
 
     except Exception as e:
         print(f"Error during query rewriting: {e}")
@@ -183,5 +254,10 @@ def rag_reply_hf(model, query, conversation, retrieved_data):
 
 def sql_planner(model, query):
     user_prompt = prompts.SQL_PLANNER_USER.format(query=query)
-    response = model.generate(prompts.SQL_PLANNER_SYS, [user_prompt])
+    response = cached_generate(model, prompts.SQL_PLANNER_SYS, [user_prompt])
+    return response
+
+async def sql_planner_async(model, query):
+    user_prompt = prompts.SQL_PLANNER_USER.format(query=query)
+    response = await cached_generate_async(model, prompts.SQL_PLANNER_SYS, [user_prompt])
     return response
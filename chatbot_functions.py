@@ -6,11 +6,15 @@ from xml.etree.ElementTree import ParseError
 from typing import Callable, Dict, List, Union
 import random
 # from lorax import Client
-from openai import OpenAI
+from aixparag.clients import get_openai_client, get_async_openai_client, get_settings
 from fastapi import FastAPI
 from fastapi.responses import StreamingResponse
-from aixparag.RAGmain import rag_answer,rag_answer_highlight
+from aixparag.RAGmain import rag_answer,rag_answer_highlight, rag_answer_async, rag_answer_highlight_async
+from aixparag.cache import LRUCache
+from aixparag.global_cache import _GLOBAL_CACHES
+import asyncio
 import datetime
+import hashlib
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -81,15 +85,12 @@ def create_chat_prompt (documents_list, dialogue_list, user, tone, chatbot_is_fi
     return chatbot_prompt_list
 
 def stream_answer(documents_list, dialogue_list, user, tone, chatbot_is_first):
-    from start_api import start_api_openai_base_url, start_api_openai_key, start_api_openai_model
+    start_api_openai_model = get_settings().model
     
     chatbot_prompt_list = create_chat_prompt (documents_list, dialogue_list, user, tone, chatbot_is_first)
 
    
-    client = OpenAI(
-        base_url = start_api_openai_base_url,
-        api_key=start_api_openai_key
-    )
+    client = get_openai_client()
 
     
     # Generate next turn
@@ -100,7 +101,9 @@ def stream_answer(documents_list, dialogue_list, user, tone, chatbot_is_first):
         stream=True
     )  
     
-    async def event_generator():
+    # a plain generator: Starlette iterates it in a worker thread, so the
+    # blocking reads of the sync client do not stall the event loop
+    def event_generator():
         for chunk in stream:
             content = chunk.choices[0].delta.content
             if content:
@@ -110,14 +113,11 @@ def stream_answer(documents_list, dialogue_list, user, tone, chatbot_is_first):
 
 
 def generate_answer(documents_list, dialogue_list, user, tone, chatbot_is_first):
-    from start_api import start_api_openai_base_url, start_api_openai_key, start_api_openai_model
+    start_api_openai_model = get_settings().model
     
     chatbot_prompt_list = create_chat_prompt (documents_list, dialogue_list, user, tone, chatbot_is_first)
     
-    client = OpenAI(
-        base_url = start_api_openai_base_url,
-        api_key=start_api_openai_key
-    )
+    client = get_openai_client()
 
     # Generate next turn
     message = client.chat.completions.create(
@@ -136,7 +136,7 @@ def generate_answer(documents_list, dialogue_list, user, tone, chatbot_is_first)
 
 
 def stream_answer_rag(documents_list, dialogue_list, user, tone, chatbot_is_first, hf_token):
-    from start_api import start_api_openai_base_url, start_api_openai_key, start_api_openai_model
+    start_api_openai_model = get_settings().model
     
     output_rag = get_ground_rag(documents_list, dialogue_list, 5, hf_token, chatbot_is_first) #the number of item (5) do nothing
     ground_rag = []
@@ -150,10 +150,7 @@ def stream_answer_rag(documents_list, dialogue_list, user, tone, chatbot_is_firs
 
     chatbot_prompt_list = create_chat_prompt(ground_rag, dialogue_list, user, tone, chatbot_is_first)
    
-    client = OpenAI(
-        base_url = start_api_openai_base_url,
-        api_key=start_api_openai_key
-    )
+    client = get_openai_client()
 
     
     # Generate next turn
@@ -166,7 +163,9 @@ def stream_answer_rag(documents_list, dialogue_list, user, tone, chatbot_is_firs
         stream=True
     )  
     
-    async def event_generator():
+    # a plain generator: Starlette iterates it in a worker thread, so the
+    # blocking reads of the sync client do not stall the event loop
+    def event_generator():
         for chunk in stream:
             content = chunk.choices[0].delta.content
             if content:
@@ -176,7 +175,7 @@ def stream_answer_rag(documents_list, dialogue_list, user, tone, chatbot_is_firs
 
 
 def generate_answer_rag(documents_list, dialogue_list, user, tone, chatbot_is_first, hf_token):
-    from start_api import start_api_openai_base_url, start_api_openai_key, start_api_openai_model
+    start_api_openai_model = get_settings().model
     
     output_rag = get_ground_rag(documents_list, dialogue_list, 5, hf_token, chatbot_is_first) #the number of item (5) do nothing
     # logger.info("RAG output:")
@@ -190,10 +189,7 @@ def generate_answer_rag(documents_list, dialogue_list, user, tone, chatbot_is_fi
     logger.info("Chatbot prompt list:")
     logger.info(chatbot_prompt_list)
     # start = datetime.datetime.now().timestamp()
-    client = OpenAI(
-        base_url = start_api_openai_base_url,
-        api_key=start_api_openai_key
-    )
+    client = get_openai_client()
     # Generate next turn
     message = client.chat.completions.create(
         # model="c320",
@@ -217,30 +213,142 @@ def generate_answer_rag(documents_list, dialogue_list, user, tone, chatbot_is_fi
 
 
 
-def get_ground(documents_list, query, options_number):
+def _sse_event(content):
+    # json keeps newlines inside the token from breaking the event framing
+    return f"data: {json.dumps({'content': content}, ensure_ascii=False)}\n\n"
+
+
+def stream_tokens(stream, request=None, sse=False):
+    """
+    Forwards the tokens of an async OpenAI stream as soon as they arrive.
+
+    If ``request`` is given, the client connection is checked between tokens and
+    the upstream stream is closed when the client goes away, so the model server
+    stops generating an answer nobody reads. With ``sse`` the tokens are sent as
+    server-sent events (``data: {"content": ...}``), terminated by ``data: [DONE]``.
+    """
+    async def event_generator():
+        try:
+            async for chunk in stream:
+                if request is not None and await request.is_disconnected():
+                    logger.info("Client disconnected, cancelling the generation")
+                    break
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield _sse_event(content) if sse else content
+            else:
+                if sse:
+                    yield "data: [DONE]\n\n"
+        finally:
+            # also reached when the response task is cancelled on disconnect
+            await stream.close()
+
+    if sse:
+        return StreamingResponse(event_generator(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return StreamingResponse(event_generator(), media_type="application/json")
+
+
+async def stream_answer_async(documents_list, dialogue_list, user, tone, chatbot_is_first, request=None, sse=False):
+    chatbot_prompt_list = create_chat_prompt(documents_list, dialogue_list, user, tone, chatbot_is_first)
+
+    # Generate next turn
+    stream = await get_async_openai_client().chat.completions.create(
+        model=get_settings().model,
+        messages=chatbot_prompt_list,
+        temperature=0.2,
+        stream=True
+    )
+    return stream_tokens(stream, request, sse)
+
+
+async def stream_answer_rag_async(documents_list, dialogue_list, user, tone, chatbot_is_first, hf_token, request=None, sse=False):
+    start_api_openai_model = get_settings().model
+    
+    output_rag = await get_ground_rag_async(documents_list, dialogue_list, 5, hf_token, chatbot_is_first) #the number of item (5) do nothing
+    ground_rag = [g["text"] for g in output_rag]
+
+    chatbot_prompt_list = create_chat_prompt(ground_rag, dialogue_list, user, tone, chatbot_is_first)
+   
+    client = get_async_openai_client()
+
+    # Generate next turn
+    stream = await client.chat.completions.create(
+        model = start_api_openai_model,
+        messages=chatbot_prompt_list,
+        temperature=0.2,
+        stream=True
+    )  
+    return stream_tokens(stream, request, sse)
+
+
+async def generate_answer_rag_async(documents_list, dialogue_list, user, tone, chatbot_is_first, hf_token):
+    start_api_openai_model = get_settings().model
+    
+    output_rag = await get_ground_rag_async(documents_list, dialogue_list, 5, hf_token, chatbot_is_first) #the number of item (5) do nothing
+    ground_rag = [g["text"] for g in output_rag]
+
+    chatbot_prompt_list = create_chat_prompt(ground_rag, dialogue_list, user, tone, chatbot_is_first)
+    logger.info("Chatbot prompt list:")
+    logger.info(chatbot_prompt_list)
+    client = get_async_openai_client()
+    # Generate next turn
+    response = await client.chat.completions.create(
+        model = start_api_openai_model,
+        messages=chatbot_prompt_list,
+        temperature=0.2,
+    )
+
+    next_turn = {
+            "turn_text": response.choices[0].message.content,
+        }        
+    
+    return next_turn
+
+
 
-    chunks = chunker.Chunker_llama_index(
-            documents_list  = documents_list, 
-            chunk_size    = 200,
-            chunk_overlap = 0
-            )   
+# BM25 retrievers over the chunked documents, keyed by a hash of documents_list
+_GROUND_RETRIEVERS = LRUCache(maxsize=16)
+_GLOBAL_CACHES["ground_bm25"] = _GROUND_RETRIEVERS
+
+
+def _ground_retriever(documents_list):
+    key = hashlib.sha256(json.dumps(documents_list, ensure_ascii=False).encode("utf-8")).hexdigest()
+    retr = _GROUND_RETRIEVERS.get(key)
+    if retr is None:
+        chunks = chunker.Chunker_llama_index(
+                documents_list  = documents_list, 
+                chunk_size    = 200,
+                chunk_overlap = 0,
+                store = False
+                )   
+
+        retr = retrieval.Retriever_bm25(
+            knowledge_base=chunks,
+            name="BM25"
+            )
+        _GROUND_RETRIEVERS.set(key, retr)
+    return retr
+
+
+def get_ground(documents_list, query, options_number):
 
-    retr = retrieval.Retriever_bm25(
-        knowledge_base=chunks,
-        name="BM25",
-        top_k=options_number
-        )
+    # repeated requests on the same plans skip chunking and indexing
+    retr = _ground_retriever(documents_list)
 
-    retrieved_chunks = retr.retrieve(query)
+    retrieved_chunks = retr.retrieve(query, top_k=options_number)
 
     grounds_list = []
+    finder = span.SpanFinder(documents_list)
     for chunk in retrieved_chunks:
 
         ground_info = dict()
         
         g_text =   chunk.text
         g_doc = chunk.metadata["document_id"]
-        index_start, index_end = span.find_indexes(documents_list[g_doc],g_text)
+        index_start, index_end = finder.find_indexes(g_doc, g_text)
         
         ground_info["text"] = g_text
         ground_info["file_index"] = g_doc
@@ -252,11 +360,33 @@ def get_ground(documents_list, query, options_number):
     return grounds_list
 
 
-def get_ground_highlight(documents_list, query, options_number, hf_token):
-
-    retrieved_chunks = rag_answer_highlight(documents_list,query, options_number, hf_token)
+def _fuzzy_ground(finder, text, chunk_clean):
+    # no exact match (whitespace or encoding differences): align approximately,
+    # with the score as confidence; placeholder span if nothing is close enough
+    match = finder.find_fuzzy(chunk_clean)
+    if match is None:
+        return {
+            "text": text,
+            "file_index": 0,  # or -1 if you prefer
+            "offset_start": 0,
+            "offset_end": 1,
+            "score": 0.0
+        }
+    i, index_start, index_end, score = match
+    return {
+        "text": text,
+        "file_index": i,
+        "offset_start": index_start,
+        "offset_end": index_end,
+        "score": round(score, 3)
+    }
+
+
+def _ground_highlight_chunks(documents_list, retrieved_chunks):
 
     grounds_list = [] 
+    # every document is normalized once for all the chunks
+    finder = span.SpanFinder(documents_list)
 
     # print("retrieved_chunks LIST")
     # print(retrieved_chunks)
@@ -269,40 +399,40 @@ def get_ground_highlight(documents_list, query, options_number, hf_token):
             chunk_clean = chunk
 
         found = False
-        for i, doc in enumerate(documents_list):
-            index_start, index_end = span.find_indexes(documents_list[i], chunk_clean.strip())
-            # logger.info("INDEXES", index_start, index_end, "DOC INDEX", i)
-            # logger.info("DOC INDEX", i,"First 100 chars of doc:", documents_list[i][:100])
-            # Only add if indexes are valid
-            if index_start is not None and index_end is not None:
-                ground_info = {
-                    "text": chunk_clean,
-                    "file_index": i,
-                    "offset_start": index_start,
-                    "offset_end": index_end
-                }
-                grounds_list.append(ground_info)
-                found = True
+        for i, index_start, index_end in finder.find_all(chunk_clean.strip()):
+            ground_info = {
+                "text": chunk_clean,
+                "file_index": i,
+                "offset_start": index_start,
+                "offset_end": index_end,
+                "score": 1.0
+            }
+            grounds_list.append(ground_info)
+            found = True
         
         if not found:
-            grounds_list.append({
-                "text": chunk_clean,
-                "file_index": 0,  # or -1 if you prefer
-                "offset_start": 0,
-                "offset_end": 1
-            })
+            grounds_list.append(_fuzzy_ground(finder, chunk_clean, chunk_clean.strip()))
 
     return grounds_list
 
 
-def get_ground_rag(documents_list, dialogue_list, options_number, hf_token, chatbot_is_first):
-    
-    query = dialogue_list[-1]['turn_text']
-    
-    retrieved_chunks = rag_answer(documents_list, dialogue_list, query, options_number, hf_token, chatbot_is_first)
-    # logger.info("Retrieved chunks (GROUND RAG):")
-    # logger.info(retrieved_chunks)
+def get_ground_highlight(documents_list, query, options_number, hf_token):
+
+    retrieved_chunks = rag_answer_highlight(documents_list,query, options_number, hf_token)
+    return _ground_highlight_chunks(documents_list, retrieved_chunks)
+
+
+async def get_ground_highlight_async(documents_list, query, options_number, hf_token):
+
+    retrieved_chunks = await rag_answer_highlight_async(documents_list, query, options_number, hf_token)
+    return await asyncio.to_thread(_ground_highlight_chunks, documents_list, retrieved_chunks)
+
+
+def _ground_rag_chunks(documents_list, retrieved_chunks):
+
     grounds_list = [] 
+    # every document is normalized once for all the chunks
+    finder = span.SpanFinder(documents_list)
 
     for chunk in retrieved_chunks:
         
@@ -312,27 +442,35 @@ def get_ground_rag(documents_list, dialogue_list, options_number, hf_token, chat
             chunk_clean = chunk
         
         found = False
-        for i, doc in enumerate(documents_list):
-            index_start, index_end = span.find_indexes(documents_list[i], chunk_clean)
-
-            # Only add if indexes are valid
-            if index_start is not None and index_end is not None:
-                ground_info = {
-                    "text": chunk,
-                    "file_index": i,
-                    "offset_start": index_start,
-                    "offset_end": index_end
-                }
-                grounds_list.append(ground_info)
-                found = True
+        for i, index_start, index_end in finder.find_all(chunk_clean):
+            ground_info = {
+                "text": chunk,
+                "file_index": i,
+                "offset_start": index_start,
+                "offset_end": index_end,
+                "score": 1.0
+            }
+            grounds_list.append(ground_info)
+            found = True
 
         if not found:
-            grounds_list.append({
-                "text": chunk,
-                "file_index": 0,  # or -1 if you prefer
-                "offset_start": 0,
-                "offset_end": 1
-            })
+            grounds_list.append(_fuzzy_ground(finder, chunk, chunk_clean))
     return grounds_list
 
 
+def get_ground_rag(documents_list, dialogue_list, options_number, hf_token, chatbot_is_first):
+    
+    query = dialogue_list[-1]['turn_text']
+    
+    retrieved_chunks = rag_answer(documents_list, dialogue_list, query, options_number, hf_token, chatbot_is_first)
+    # logger.info("Retrieved chunks (GROUND RAG):")
+    # logger.info(retrieved_chunks)
+    return _ground_rag_chunks(documents_list, retrieved_chunks)
+
+
+async def get_ground_rag_async(documents_list, dialogue_list, options_number, hf_token, chatbot_is_first):
+    
+    query = dialogue_list[-1]['turn_text']
+    
+    retrieved_chunks = await rag_answer_async(documents_list, dialogue_list, query, options_number, hf_token, chatbot_is_first)
+    return await asyncio.to_thread(_ground_rag_chunks, documents_list, retrieved_chunks)
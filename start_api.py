@@ -1,18 +1,22 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 import uvicorn
 import os
 from chatbot_functions import generate_answer, get_ground, stream_answer, get_ground_rag, generate_answer_rag, get_ground_highlight, stream_answer_rag
+from chatbot_functions import get_ground_rag_async, generate_answer_rag_async, get_ground_highlight_async, stream_answer_rag_async
 import chatbot_functions_mock as mock
 # from auth import app as auth_app, get_current_active_user, User
 import time
+import signal
 import argparse
 import json 
 from typing import List, Optional, Dict
 from pydantic import BaseModel
 from aixparag import RAGmain
 from aixparag.data_preparation import extract_metadata
-from aixparag.Retriever import Retriever
 from aixparag.global_cache import _GLOBAL_RERANKERS
+from aixparag.cache import configure_response_cache, configure_embedding_cache, configure_rerank_cache, cache_stats
+from aixparag.clients import configure_clients
+from aixparag.VectorStoreMmap import get_embeddings
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import digitalhub as dh
@@ -28,6 +32,19 @@ parser.add_argument('--mock', action='store_true')
 parser.add_argument('--data_artifact', default=None)
 parser.add_argument('--storage_artifact', default=None)
 parser.add_argument('--prepare_data', action='store_true')
+parser.add_argument('--workers', default=int(os.environ.get("WORKERS", "1")), type=int)
+parser.add_argument('--embed_batch_size', default=int(os.environ.get("EMBED_BATCH_SIZE", "64")), type=int)
+parser.add_argument('--embed_workers', default=int(os.environ.get("EMBED_WORKERS", "1")), type=int)
+parser.add_argument('--response_cache_size', default=int(os.environ.get("RESPONSE_CACHE_SIZE", "2048")), type=int)
+parser.add_argument('--response_cache_ttl', default=float(os.environ.get("RESPONSE_CACHE_TTL", "86400")), type=float)
+parser.add_argument('--response_cache_path', default=os.environ.get("RESPONSE_CACHE_PATH"))
+parser.add_argument('--response_cache_similarity', default=float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0")), type=float)
+parser.add_argument('--embedding_cache_size', default=int(os.environ.get("EMBEDDING_CACHE_SIZE", "20000")), type=int)
+parser.add_argument('--embedding_cache_path', default=os.environ.get("EMBEDDING_CACHE_PATH"))
+parser.add_argument('--rerank_cache_size', default=int(os.environ.get("RERANK_CACHE_SIZE", "50000")), type=int)
+parser.add_argument('--reranker_backend', default=os.environ.get("RERANKER_BACKEND", "torch"), choices=["torch", "onnx", "onnx-fp32"])
+parser.add_argument('--openai_pool_size', default=int(os.environ.get("OPENAI_POOL_SIZE", "100")), type=int)
+parser.add_argument('--openai_timeout', default=float(os.environ.get("OPENAI_TIMEOUT", "120")), type=float)
 args = parser.parse_args()
 
 start_api_openai_base_url = args.openai_base_url
@@ -36,11 +53,37 @@ start_api_openai_model = args.openai_model
 start_api_openai_base_model = args.openai_base_model
 start_api_mock = args.mock or os.environ.get("MOCK", "False").lower() == "true"
 hf_token = os.environ.get("HF_TOKEN", "")
+# seconds before a prefork worker that exited is started again
+WORKER_RESTART_DELAY = 1.0
 
 # aixpa-new-ground
 
 
 _GLOBAL_RERANKERS["reranker_hf_model"] = 'nickprock/cross-encoder-italian-bert-stsb'
+_GLOBAL_RERANKERS["reranker_backend"] = args.reranker_backend
+
+# one pooled (keep-alive) OpenAI client per process, shared by all requests
+configure_clients(start_api_openai_base_url, start_api_openai_key,
+                  start_api_openai_model, start_api_openai_base_model,
+                  pool_size=args.openai_pool_size, timeout=args.openai_timeout)
+
+# cache of query rewrites and router decisions (size 0 disables it)
+if args.response_cache_size > 0:
+    configure_response_cache(
+        maxsize=args.response_cache_size,
+        ttl=args.response_cache_ttl or None,
+        path=args.response_cache_path,
+        # near-duplicate lookup on the prompt embedding, when a threshold is given
+        embedder=(lambda text: get_embeddings(RAGmain.EMBEDDING_MODEL_NAME).embed_query(text))
+                 if args.response_cache_similarity > 0 else None,
+        similarity_threshold=args.response_cache_similarity,
+    )
+
+# embeddings of documents and queries, by model and text hash (float16 on disk if a path is given)
+configure_embedding_cache(maxsize=args.embedding_cache_size, path=args.embedding_cache_path)
+
+# reranker scores of (query, passage) pairs (size 0 disables it)
+configure_rerank_cache(maxsize=args.rerank_cache_size)
 
 
 # instantiate FastApi application
@@ -65,21 +108,20 @@ app.add_middleware(
 # RAGmain.create_vector_store()
 
 def read_txt_files(folder_path):
-    contents = []
-    for filename in os.listdir(folder_path):
+    # keyed by file name, so that action ids do not depend on the listing order
+    contents = {}
+    for filename in sorted(os.listdir(folder_path)):
         if filename.endswith(".txt"):
             file_path = os.path.join(folder_path, filename)
             print(filename)
             with open(file_path, "r", encoding="utf-8") as f:
-                contents.append(f.read())
+                contents[os.path.splitext(filename)[0]] = f.read()
     return contents
 
-def init_app():
-    start_time = time.time()
-    print(start_time, "Data Creation RAG")
-    print("start_api_openai_base_url", start_api_openai_base_url)
-    print("start_api_mock", start_api_mock)
-
+def prepare_index():
+    """
+    Downloads the artifacts and creates (or incrementally updates) the vector index.
+    """
     if not start_api_mock:
 
         if args.data_artifact is not None:
@@ -90,22 +132,116 @@ def init_app():
             project = dh.get_or_create_project(os.environ.get("PROJECT_NAME"))
             project.get_artifact(args.storage_artifact).download("aixparag/data", overwrite=True)
 
-        if not os.path.exists("aixparag/data/vector_store.pkl"):
+        if os.path.isdir("RAG_documents") or not RAGmain.vector_store_exists():
             documents_list = read_txt_files("RAG_documents")
             print("Loaded " + str(len(documents_list)) + " documents")
             extract_metadata(documents_list)
-            my_vector_store = RAGmain.create_vector_store()
+            # incremental: only new or changed actions are embedded
+            RAGmain.create_vector_store(batch_size=args.embed_batch_size,
+                                        num_workers=args.embed_workers)
 
-            Retriever(vector_store=my_vector_store, reranker_model_name=_GLOBAL_RERANKERS["reranker_hf_model"])
-            print(_GLOBAL_RERANKERS["reranker_hf_model"])
-        
-        RAGmain.load_vector_store()
+
+def init_app():
+    start_time = time.time()
+    print(start_time, "Data Creation RAG")
+    print("start_api_openai_base_url", start_api_openai_base_url)
+    print("start_api_mock", start_api_mock)
+
+    prepare_index()
+    if not start_api_mock:
+        RAGmain.warmup()
+
+
+def prepare_index_spawned():
+    """
+    Runs prepare_index in a spawned process: embedding the corpus runs the model on
+    all the cores and allocates memory that the forked workers do not need.
+    """
+    import multiprocessing
+
+    process = multiprocessing.get_context("spawn").Process(target=prepare_index)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise SystemExit(f"Index preparation failed (exit code {process.exitcode})")
+
+
+def serve_prefork(workers):
+    """
+    Serves the app with `workers` forked processes sharing one listening socket.
+
+    The index must already be prepared (see prepare_index_spawned). This process
+    loads the index and the models once, with a single torch thread and without
+    running them, so that no intra-op thread pool exists when forking; the workers
+    share the model weights and the memory-mapped corpus, and each one sets its
+    own thread count after the fork. Workers that exit are reported and restarted
+    until SIGTERM/SIGINT.
+    """
+    import gc
+    import torch
+
+    # loading runs no inference: with one thread no thread pool is started before the fork
+    torch.set_num_threads(1)
+    RAGmain.warmup()
+
+    config = uvicorn.Config(app, host=args.host, port=args.port)
+    sock = config.bind_socket()
+    threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    # keep the GC from touching (and so copying) the pages inherited from the parent
+    gc.freeze()
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            # uvicorn installs its own handlers; drop the supervisor's ones
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            torch.set_num_threads(threads_per_worker)
+            uvicorn.Server(config).run(sockets=[sock])
+            os._exit(0)
+        return pid
+
+    children = [start_worker() for _ in range(workers)]
+    print(f"Started {workers} workers: {children}")
+    stopping = False
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        children.remove(pid)
+        if stopping:
+            continue
+        print(f"Worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, restarting it")
+        # do not spin if workers die at startup
+        time.sleep(WORKER_RESTART_DELAY)
+        if not stopping:
+            children.append(start_worker())
+            print(f"Started worker {children[-1]}")
 
 
 @app.get('/')
 async def version():
     return {"version": app.version}
 
+@app.get('/cache_stats')
+async def get_cache_stats():
+    return cache_stats()
+
 class TurnGenerationRequest(BaseModel):
     documents_list: List[str]
     dialogue_list: List[dict]
@@ -138,43 +274,50 @@ class DataCreationRAG(BaseModel):
 
 
 @app.post('/turn_generation')
-def dialogue_generation_dynamic(request: TurnGenerationRequest):
+async def dialogue_generation_dynamic(request: TurnGenerationRequest):
     start_time = time.time()
     print(start_time, "Request turn generation")
     if start_api_mock:
         return mock.generate_answer(request.documents_list, request.dialogue_list, request.user, request.tone, request.chatbot_is_first)
-    return generate_answer_rag(request.documents_list, request.dialogue_list, request.user, request.tone, request.chatbot_is_first, hf_token)
+    return await generate_answer_rag_async(request.documents_list, request.dialogue_list, request.user, request.tone, request.chatbot_is_first, hf_token)
 
 @app.post('/turn_stream')
-def dialogue_generation_dynamic(request: TurnGenerationRequest):
+async def dialogue_generation_dynamic(request: TurnGenerationRequest, http_request: Request, sse: bool = False):
     start_time = time.time()
     print(start_time, "Request turn Stream")
     if start_api_mock:
         return mock.stream_answer(request.documents_list, request.dialogue_list, request.user, request.tone, request.chatbot_is_first)
-    return stream_answer_rag(request.documents_list, request.dialogue_list, request.user, request.tone, request.chatbot_is_first, hf_token)
+    # server-sent events on ?sse=true or when the client accepts them
+    sse = sse or "text/event-stream" in http_request.headers.get("accept", "")
+    return await stream_answer_rag_async(request.documents_list, request.dialogue_list, request.user, request.tone, request.chatbot_is_first, hf_token,
+                                         request=http_request, sse=sse)
 
 
 @app.post('/turn_ground')
-def dialogue_generation_dynamic(request: TurnGroundRequest):
+async def dialogue_generation_dynamic(request: TurnGroundRequest):
     start_time = time.time()
     print(start_time, "Request ground")
     if start_api_mock:
         return mock.get_ground(request.documents_list, request.query, request.options_number)
-    return get_ground_highlight(request.documents_list, request.query, request.options_number, hf_token)
+    return await get_ground_highlight_async(request.documents_list, request.query, request.options_number, hf_token)
 
 
 @app.post('/turn_ground_rag')
-def dialogue_generation_dynamic(request: TurnGroundRequestRAG):
+async def dialogue_generation_dynamic(request: TurnGroundRequestRAG):
     start_time = time.time()
     print(start_time, "Request ground RAG")
-    return get_ground_rag(request.documents_list, request.dialogue_list, request.options_number, hf_token, request.chatbot_is_first)
+    return await get_ground_rag_async(request.documents_list, request.dialogue_list, request.options_number, hf_token, request.chatbot_is_first)
 
 
 if __name__ == '__main__':
-    init_app()
     prepare_data = args.prepare_data or os.environ.get("PREPARE_DATA", "False").lower() == "true"
     if prepare_data:
+        init_app()
         project = dh.get_or_create_project(os.environ.get("PROJECT_NAME"))
         art = project.log_artifact("rag_storage", kind="artifact", source="./aixparag/data")
+    elif args.workers > 1 and hasattr(os, "fork") and not start_api_mock:
+        prepare_index_spawned()
+        serve_prefork(args.workers)
     else:
-        uvicorn.run("start_api:app", host=args.host, port=args.port, workers=1)
+        init_app()
+        uvicorn.run("start_api:app", host=args.host, port=args.port, workers=args.workers)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# aixparag and tools are imported from the repository root, as start_api does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
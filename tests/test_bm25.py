@@ -0,0 +1,86 @@
+import math
+
+import numpy as np
+import pytest
+
+from tools.bm25 import BM25Index, whitespace_tokenizer, word_tokenizer
+
+CORPUS = [
+    "Festa dei nuovi nati a Trento",
+    "Centro estivo per ragazzi e ragazze",
+    "Sportello UTED per le famiglie",
+    "Festa di fine estate per le famiglie con bambini",
+    "Corso di nuoto per bambini",
+    "Centro estivo",
+]
+QUERIES = ["festa per le famiglie", "centro estivo bambini", "UTED", "parola assente", "per per per"]
+
+
+def okapi_scores(corpus, query, k1=1.5, b=0.75, epsilon=0.25):
+    # BM25Okapi as in rank_bm25, written out term by term
+    docs = [whitespace_tokenizer(text) for text in corpus]
+    avgdl = sum(len(doc) for doc in docs) / len(docs)
+    df = {}
+    for doc in docs:
+        for term in set(doc):
+            df[term] = df.get(term, 0) + 1
+    idf = {term: math.log(len(docs) - n + 0.5) - math.log(n + 0.5) for term, n in df.items()}
+    floor = epsilon * sum(idf.values()) / len(idf)
+    idf = {term: value if value >= 0 else floor for term, value in idf.items()}
+    scores = []
+    for doc in docs:
+        score = 0.0
+        for term in whitespace_tokenizer(query):
+            tf = doc.count(term)
+            score += idf.get(term, 0.0) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avgdl))
+        scores.append(score)
+    return np.array(scores)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_scores_match_okapi(query):
+    index = BM25Index(CORPUS)
+    np.testing.assert_allclose(index.get_scores(query), okapi_scores(CORPUS, query), rtol=1e-5, atol=1e-6)
+
+
+# rank_bm25.BM25Okapi (0.2.2) scores of QUERIES over CORPUS, whitespace tokens, computed once
+RANK_BM25_SCORES = {
+    "festa per le famiglie": [0.0, 0.240341, 1.486561, 1.108354, 0.260844, 0.0],
+    "centro estivo bambini": [0.0, 0.564686, 0.0, 0.456937, 0.612858, 0.82365],
+    "UTED": [0.0, 0.0, 1.354703, 0.0, 0.0, 0.0],
+    "parola assente": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+    "per per per": [0.0, 0.721024, 0.782533, 0.583444, 0.782533, 0.0],
+}
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_scores_match_rank_bm25(query):
+    np.testing.assert_allclose(BM25Index(CORPUS).get_scores(query), RANK_BM25_SCORES[query], rtol=1e-5, atol=1e-6)
+
+
+def test_batch_scores_match_single_queries():
+    index = BM25Index(CORPUS)
+    batch = index.get_scores_batch(QUERIES)
+    for row, query in zip(batch, QUERIES):
+        np.testing.assert_array_equal(row, index.get_scores(query))
+
+
+def test_save_and_load(tmp_path):
+    index = BM25Index(CORPUS, tokenizer=word_tokenizer)
+    index.save(str(tmp_path))
+    assert BM25Index.exists(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path), tokenizer=word_tokenizer)
+    assert len(loaded) == len(CORPUS)
+    for query in QUERIES:
+        np.testing.assert_array_equal(loaded.get_scores(query), index.get_scores(query))
+
+
+def test_word_tokenizer_ignores_case_and_punctuation():
+    index = BM25Index(CORPUS, tokenizer=word_tokenizer)
+    scores = index.get_scores("uted,")
+    assert np.argmax(scores) == 2
+    assert np.count_nonzero(scores) == 1
+
+
+def test_empty_corpus():
+    assert len(BM25Index([]).get_scores("festa")) == 0
@@ -0,0 +1,82 @@
+import os
+import random
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from aixparag import gazetteer
+from aixparag.global_cache import _GLOBAL_CACHES
+from aixparag.gazetteer import Gazetteer, get_gazetteer, reset_gazetteer
+
+CITIES = ["Ala", "Arco", "Borgo Valsugana", "Riva del Garda", "Riva", "San Michele", "Michele", "arco"]
+
+
+def baseline(cities, documents):
+    # find_cities_in_first_lines before the gazetteer
+    found_cities = []
+    for doc in documents:
+        first_line = doc.splitlines()[0] if doc else ""
+        for city in cities:
+            if " " + city.lower() + " " in first_line.lower():
+                found_cities.append(city.lower())
+    return found_cities
+
+
+@pytest.fixture(autouse=True)
+def clean_gazetteer():
+    reset_gazetteer()
+    yield
+    reset_gazetteer()
+
+
+@pytest.mark.parametrize("documents", [
+    [],
+    [""],
+    ["COMUNE DI: Arco \n testo"],
+    ["Piano del comune di Riva del Garda e di Arco (2024)\nRiva "],
+    ["comune di  ala  e ala "],
+    [" San Michele Michele \n", "\nArco "],
+    ["ARCO e Borgo Valsugana e BORGO valsugana ", "Riva del Garda"],
+])
+def test_matches_baseline(documents):
+    assert Gazetteer(CITIES).find_in_first_lines(documents) == baseline(CITIES, documents)
+
+
+def test_matches_baseline_on_random_lines():
+    rng = random.Random(0)
+    words = [city.lower() for city in CITIES] + ["di", "comune", "del", "garda", "x", "ARCO", "Ala"]
+    gazetteer_ = Gazetteer(CITIES)
+    for _ in range(2000):
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(0, 8)))
+        documents = [rng.choice([line, " " + line + " ", line + "\nArco ", ""])]
+        assert gazetteer_.find_in_first_lines(documents) == baseline(CITIES, documents)
+
+
+def test_results_are_memoized():
+    gazetteer_ = Gazetteer(CITIES)
+    documents = ["Comune di Arco e Ala \n"]
+    assert gazetteer_.find_in_first_lines(documents) == ["ala", "arco", "arco"]
+    hits = gazetteer_.memo.hits
+    assert gazetteer_.find_in_first_lines(documents) == ["ala", "arco", "arco"]
+    assert gazetteer_.memo.hits == hits + 1
+
+
+def test_memo_is_per_city_list():
+    documents = ["Comune di Arco e Ala \n"]
+    assert Gazetteer(["Arco"]).find_in_first_lines(documents) == ["arco"]
+    assert Gazetteer(["Ala"]).find_in_first_lines(documents) == ["ala"]
+
+
+def test_reset_reloads_the_city_list(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("aixparag/data")
+    with open(gazetteer.CITIES_PATH, "w", encoding="utf-8") as f:
+        f.write("Arco\n")
+    assert get_gazetteer().find_in_first_lines(["Comune di Arco e Ala "]) == ["arco"]
+    assert _GLOBAL_CACHES["gazetteer"] is get_gazetteer().memo
+
+    with open(gazetteer.CITIES_PATH, "w", encoding="utf-8") as f:
+        f.write("Ala\nArco\n")
+    reset_gazetteer()
+    assert get_gazetteer().find_in_first_lines(["Comune di Arco e Ala "]) == ["ala", "arco"]
@@ -0,0 +1,105 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from aixparag import VectorStoreMmap as vector_store_module
+from aixparag.cache import CachedEmbeddings, configure_embedding_cache
+from aixparag.indexer import action_point_id, build_documents, sync_vector_store
+from aixparag.VectorStoreMmap import MmapVectorStore
+
+MODEL_NAME = "test/fake-embeddings"
+
+
+class FakeEmbeddings:
+    """
+    Deterministic 8-dimensional embeddings, counting the texts it embeds.
+    """
+
+    def __init__(self):
+        self.embedded = []
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:4], "little")
+        return np.random.default_rng(seed).standard_normal(8).tolist()
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    configure_embedding_cache(maxsize=1000)
+    fake = FakeEmbeddings()
+    wrapped = CachedEmbeddings(fake, MODEL_NAME)
+    monkeypatch.setattr(vector_store_module, "get_embeddings", lambda model_name: wrapped)
+    return fake
+
+
+def make_data(actions):
+    # data_and_metadata.json shape: one plan with the given {action_id: text}
+    return {"plan": {"place": "Arco",
+                     "actions": [{"action_id": action_id, "action_text": text} for action_id, text in actions.items()],
+                     "actions_metadata": [{"tassonomia": "Servizi", "macro-ambito": "Famiglia"} for _ in actions]}}
+
+
+def texts_by_id(store):
+    return {store._ids[row]: store._payloads[row]["page_content"] for row in range(len(store))}
+
+
+def test_sync_adds_changes_and_deletes(embeddings, tmp_path):
+    store = MmapVectorStore(model_name=MODEL_NAME)
+    actions = {"a1": "Festa dei nuovi nati", "a2": "Centro estivo", "a3": "Sportello famiglie"}
+
+    stats = sync_vector_store(store, build_documents(make_data(actions)))
+    assert stats == {"added": 3, "updated": 0, "deleted": 0, "unchanged": 0}
+    assert len(embeddings.embedded) == 3
+
+    stats = sync_vector_store(store, build_documents(make_data(actions)))
+    assert stats == {"added": 0, "updated": 0, "deleted": 0, "unchanged": 3}
+    assert len(embeddings.embedded) == 3
+
+    del actions["a3"]
+    actions["a2"] = "Centro estivo per ragazzi"
+    actions["a4"] = "Corso di nuoto"
+    stats = sync_vector_store(store, build_documents(make_data(actions)))
+    assert stats == {"added": 1, "updated": 1, "deleted": 1, "unchanged": 1}
+    assert sorted(embeddings.embedded[3:]) == ["COMUNE DI: Arco\nCentro estivo per ragazzi", "COMUNE DI: Arco\nCorso di nuoto"]
+
+    expected = {action_point_id(action_id): "COMUNE DI: Arco\n" + text for action_id, text in actions.items()}
+    assert texts_by_id(store) == expected
+    assert len(store._get_vectors()) == len(expected)
+
+    # hashes survive a save/load, so a reloaded index is not embedded again
+    store.save(str(tmp_path))
+    loaded = MmapVectorStore.load(str(tmp_path))
+    assert texts_by_id(loaded) == expected
+    stats = sync_vector_store(loaded, build_documents(make_data(actions)))
+    assert stats == {"added": 0, "updated": 0, "deleted": 0, "unchanged": 3}
+    assert len(embeddings.embedded) == 5
+
+
+def test_changed_metadata_updates_the_point(embeddings):
+    store = MmapVectorStore(model_name=MODEL_NAME)
+    data = make_data({"a1": "Festa dei nuovi nati"})
+    sync_vector_store(store, build_documents(data))
+
+    data["plan"]["actions_metadata"][0]["tassonomia"] = "Eventi"
+    stats = sync_vector_store(store, build_documents(data))
+    assert stats["updated"] == 1
+    assert store.db_select({"tassonomia": ["eventi"]})[0][0].id == action_point_id("a1")
+    assert store.db_select({"tassonomia": ["servizi"]})[0] == []
+
+
+def test_search_after_sync(embeddings):
+    store = MmapVectorStore(model_name=MODEL_NAME)
+    sync_vector_store(store, build_documents(make_data({"a1": "Festa dei nuovi nati", "a2": "Centro estivo"})))
+    results = store.search("COMUNE DI: Arco\nCentro estivo", k=1)
+    assert results[0].metadata["_id"] == action_point_id("a2")
+    assert results[0].metadata["_score"] == pytest.approx(1.0, abs=1e-2)
@@ -0,0 +1,86 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+RAGmain = pytest.importorskip("aixparag.RAGmain")
+
+RAW_QUERY = "Ci sono centri estivi ad Arco?"
+# the usual rewrite: the last turn with context from the dialogue
+REWRITTEN_QUERY = "Quali centri estivi ci sono nel comune di Arco per i ragazzi?"
+DIVERGING_QUERY = "Elenca le azioni per la conciliazione famiglia-lavoro del comune"
+
+
+class FakeRetriever:
+    def retrieve(self, query, k=10, filters=None, query_vector=None):
+        return [SimpleNamespace(page_content=f"{query} #{i}", metadata={"_score": 1.0 - i / 10}) for i in range(3)]
+
+    def filtered_size(self, filters=None):
+        return None
+
+    def rerank_adaptive(self, query, candidates, k=5, cutoff=False, collection_size=None):
+        return [{"page_content": doc.page_content} for doc in candidates[:k]]
+
+
+class FakeLLM:
+    """
+    Replies of the query rewrite, router and metadata extraction, recording each call.
+    """
+
+    def __init__(self, rewrite, route):
+        self.rewrite = rewrite
+        self.route = route
+        self.calls = []
+
+    async def _call(self, name, query, reply):
+        self.calls.append((name, query))
+        await asyncio.sleep(0.01)
+        return reply
+
+    def queries(self, name):
+        return [query for called, query in self.calls if called == name]
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    fake = FakeLLM(REWRITTEN_QUERY, "SEMANTIC_SEARCH")
+    monkeypatch.setattr(RAGmain.utils, "expand_query_async",
+                        lambda model, conversation: fake._call("expand_query", conversation[-1], fake.rewrite))
+    monkeypatch.setattr(RAGmain.utils, "sql_planner_async",
+                        lambda model, query: fake._call("sql_planner", query, fake.route))
+    monkeypatch.setattr(RAGmain.utils, "exctract_metadata_async",
+                        lambda model, query, *args: fake._call("exctract_metadata", query, {"luogo": ["arco"]}))
+    monkeypatch.setattr(RAGmain, "load_vector_store", lambda: None)
+    monkeypatch.setattr(RAGmain, "get_retriever", lambda: FakeRetriever())
+    monkeypatch.setattr(RAGmain, "get_async_vllm_model", lambda: None)
+    monkeypatch.setattr(RAGmain, "find_cities_in_first_lines", lambda documents: ["arco"])
+    monkeypatch.setattr(RAGmain, "_db_query", lambda store, response_dict: ["db"])
+    monkeypatch.setattr(RAGmain, "SPECULATIVE_ROUTING", True)
+    return fake
+
+
+def answer():
+    dialogue = [{"turn_text": "Buongiorno"}, {"turn_text": RAW_QUERY}]
+    return asyncio.run(RAGmain.rag_answer_async([], dialogue, None, 5, "", False))
+
+
+def test_semantic_search_keeps_the_speculative_route(llm):
+    results = answer()
+    # one call each, issued together: the rewrite does not trigger a second routing
+    assert sorted(name for name, _ in llm.calls) == ["exctract_metadata", "expand_query", "sql_planner"]
+    assert llm.queries("sql_planner") == [RAW_QUERY]
+    assert results[0].startswith(REWRITTEN_QUERY)
+
+
+def test_db_query_keeps_the_speculative_metadata(llm):
+    llm.route = "DB_QUERY"
+    assert answer() == ["db"]
+    assert sorted(name for name, _ in llm.calls) == ["exctract_metadata", "expand_query", "sql_planner"]
+
+
+def test_diverging_rewrite_is_routed_again(llm):
+    llm.rewrite = DIVERGING_QUERY
+    llm.route = "DB_QUERY"
+    assert answer() == ["db"]
+    assert llm.queries("sql_planner") == [RAW_QUERY, DIVERGING_QUERY]
+    assert llm.queries("exctract_metadata") == [RAW_QUERY, DIVERGING_QUERY]
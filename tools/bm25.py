@@ -0,0 +1,152 @@
+"""
+BM25 index stored as compact arrays.
+
+The inverted index is kept in CSR form: the postings of term ``t`` are
+``doc_ids[indptr[t]:indptr[t+1]]`` with the matching precomputed BM25 weights,
+so a query is scored with one vectorized add per query term. Scores are the
+same of rank_bm25.BM25Okapi (same idf, epsilon floor and length normalization).
+"""
+
+import json
+import os
+import re
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+def whitespace_tokenizer(text: str) -> List[str]:
+    # the tokenization used by Retriever_bm25 so far
+    return text.split(" ")
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def word_tokenizer(text: str) -> List[str]:
+    # lowercase words without punctuation, so "UTED," and "Uted" match "uted"
+    return _WORD_RE.findall(text.lower())
+
+
+# tokenizers by name, for indexes that record the one they were built with
+TOKENIZERS = {"whitespace": whitespace_tokenizer, "word": word_tokenizer}
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a list of texts.
+    """
+
+    def __init__(self,
+                 corpus: Optional[List[str]] = None,
+                 tokenizer: Callable[[str], List[str]] = whitespace_tokenizer,
+                 k1: float = 1.5,
+                 b: float = 0.75,
+                 epsilon: float = 0.25):
+        """
+        Args:
+            corpus (Optional[List[str]]): Texts to index (None for an empty index, e.g. before load).
+            tokenizer (Callable): Function splitting a text (and a query) into terms.
+            k1 (float): Term frequency saturation.
+            b (float): Length normalization.
+            epsilon (float): Floor of the negative idfs, as a fraction of the average idf.
+        """
+        self.tokenizer = tokenizer
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocabulary: Dict[str, int] = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.empty(0, dtype=np.int32)
+        self.weights = np.empty(0, dtype=np.float32)
+        self.num_docs = 0
+        if corpus is not None:
+            self.build(corpus)
+
+    def build(self, corpus: List[str]):
+        term_ids, doc_ids, tfs, doc_lens = [], [], [], []
+        for doc_id, text in enumerate(corpus):
+            counts = {}
+            tokens = self.tokenizer(text)
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                term_ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+            doc_lens.append(len(tokens))
+
+        self.num_docs = len(corpus)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float64)
+        doc_lens = np.asarray(doc_lens, dtype=np.float64)
+
+        # group the postings by term (stable: doc ids stay sorted within a term)
+        order = np.argsort(term_ids, kind="stable")
+        term_ids, doc_ids, tfs = term_ids[order], doc_ids[order], tfs[order]
+        df = np.bincount(term_ids, minlength=len(self.vocabulary))
+        self.indptr = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+        self.doc_ids = doc_ids
+
+        idf = np.log(self.num_docs - df + 0.5) - np.log(df + 0.5)
+        if len(idf):
+            idf[idf < 0] = self.epsilon * idf.mean()
+        avgdl = doc_lens.mean() if self.num_docs else 0.0
+        norm = self.k1 * (1 - self.b + self.b * doc_lens[doc_ids] / max(avgdl, 1e-12))
+        self.weights = (idf[term_ids] * tfs * (self.k1 + 1) / (tfs + norm)).astype(np.float32)
+        return self
+
+    def __len__(self):
+        return self.num_docs
+
+    def get_scores(self, query: str) -> np.ndarray:
+        """
+        BM25 score of every document for ``query`` (repeated query terms count repeatedly).
+        """
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        self._add_scores(scores, query)
+        return scores
+
+    def get_scores_batch(self, queries: List[str]) -> np.ndarray:
+        """
+        Scores of several queries, as a (number of queries, number of documents) matrix.
+        """
+        scores = np.zeros((len(queries), self.num_docs), dtype=np.float32)
+        for row, query in zip(scores, queries):
+            self._add_scores(row, query)
+        return scores
+
+    def _add_scores(self, scores: np.ndarray, query: str):
+        for token in self.tokenizer(query):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.indptr[term], self.indptr[term + 1]
+            # doc ids are unique within a term, so a fancy-indexed add is safe
+            scores[self.doc_ids[start:end]] += self.weights[start:end]
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        np.savez(os.path.join(path, "bm25.npz"), indptr=self.indptr, doc_ids=self.doc_ids, weights=self.weights)
+        with open(os.path.join(path, "bm25.json"), "w", encoding="utf-8") as f:
+            json.dump({"num_docs": self.num_docs, "k1": self.k1, "b": self.b, "epsilon": self.epsilon,
+                       "vocabulary": self.vocabulary}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str, tokenizer: Callable[[str], List[str]] = whitespace_tokenizer) -> "BM25Index":
+        """
+        Loads an index written by ``save``; ``tokenizer`` must be the one it was built with.
+        """
+        with open(os.path.join(path, "bm25.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(tokenizer=tokenizer, k1=meta["k1"], b=meta["b"], epsilon=meta["epsilon"])
+        index.num_docs = meta["num_docs"]
+        index.vocabulary = meta["vocabulary"]
+        arrays = np.load(os.path.join(path, "bm25.npz"))
+        index.indptr, index.doc_ids, index.weights = arrays["indptr"], arrays["doc_ids"], arrays["weights"]
+        return index
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "bm25.json"))
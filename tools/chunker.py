@@ -9,8 +9,11 @@ class Chunker_llama_index:
     def __init__(self,
                  documents_list,
                  chunk_size=DEFAULT_CHUNK_SIZE,
-                 chunk_overlap=DEFAULT_CHUNK_OVERLAP):
+                 chunk_overlap=DEFAULT_CHUNK_OVERLAP,
+                 store=True):
         
+        # store=False only chunks: the VectorStoreIndex is not needed by the BM25 retrievers
+
         # Imported here to avoid loading llama_index until needed
 
         from llama_index.core import (
@@ -40,7 +43,7 @@ class Chunker_llama_index:
 
         self.nodes = self.chunk_documents(chunk_size=self._chunk_size,
                                           chunk_overlap=self._chunk_overlap)
-        self.index = self.store_nodes()
+        self.index = self.store_nodes() if store else None
 
     def chunk_documents(self, chunk_size: int, chunk_overlap: int):
         """
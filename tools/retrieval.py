@@ -1,17 +1,39 @@
 from typing import List, Dict
-from openai import OpenAI
-from rank_bm25 import BM25Okapi
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 # from FlagEmbedding import BGEM3FlagModel
 import torch
 from dataclasses import dataclass
 import numpy as np
 from tools.chunker import TextNode
+from tools.bm25 import BM25Index
+from openai import OpenAI
+from aixparag.cache import embed_with_cache
 
 
 TOP_K = 5
 # url for using KUBEAI
 BASE_URL = "https://kubeai.digitalhub-dev.smartcommunitylab.it/openai/v1"
 
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores along the last axis, best first
+    (argpartition, then only the k selected scores are sorted).
+    """
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(np.arange(n), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=-1), axis=-1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
 class Retriever_llamaindex_bm25:
     """
     BM25 retriever to be used if knowledge base consist of Llamaindex chunks
@@ -75,59 +97,84 @@ class Retriever_bm25:
 
         if self.name == 'BM25':
             self.corpus = [doc.text for doc in self.knowledge_base]  # Store corpus
-            tokenized_docs = [doc.split(" ") for doc in self.corpus]
 
             if len(self.corpus) == 0:
                 print("Error: Corpus is empty! BM25 retriever cannot be initialized.")
                 self.retriever = None
                 return
-            self.retriever = BM25Okapi(tokenized_docs)
+            self.retriever = BM25Index(self.corpus)
+            # node table indexed like the BM25 documents: duplicate texts keep their own metadata
+            self.nodes = [TextNode(text=node.text.strip(), metadata=node.metadata) for node in self.knowledge_base]
             print(f"BM25 retriever initialized with {len(self.corpus)} documents.")
             
         else:
             print("RetrieverModule Error: Select a valid retriever.")
             self.retriever = None
 
-    def retrieve(self, query: str):
+    def retrieve(self, query: str, top_k: int = None):
         """
         Retrieve top n most similar chunks to the query
+        (top_k overrides the retriever's one, so a shared retriever is not mutated)
         """      
         if self.retriever is None:
             raise ValueError("Retriever is not initialized. Check if knowledge base is empty.")
 
-        text_metadata_dict = {node.dict()['text']: node.dict()['metadata'] for node in self.knowledge_base}
-        tokenized_query = query.split(" ")
-        # Ensure we're using the same corpus that was used to initialize BM25
-        retrieved_docs = self.retriever.get_top_n(tokenized_query, self.corpus, n=self.top_k)
+        top_k = self.top_k if top_k is None else top_k
+        scores = self.retriever.get_scores(query)
+        return [self.nodes[i] for i in _top_k_indices(scores, top_k)]
+
+    def retrieve_batch(self, queries: List[str], top_k: int = None) -> List[List[TextNode]]:
+        """
+        Retrieve the top n chunks of several queries at once (one score matrix, one argpartition)
+        """
+        if self.retriever is None:
+            raise ValueError("Retriever is not initialized. Check if knowledge base is empty.")
 
-        return [TextNode(text=retrieved_doc.strip(), metadata=text_metadata_dict[retrieved_doc]) for retrieved_doc in retrieved_docs]
+        top_k = self.top_k if top_k is None else top_k
+        scores = self.retriever.get_scores_batch(queries)
+        return [[self.nodes[i] for i in row] for row in _top_k_indices(scores, top_k)]
 
 class Retriever_BGE_v2_m3:
     """
     bge-reranker-v2-m3
+
+    Pairs are scored in micro-batches of similar length (bounded memory, little padding).
+    With a prefilter the cross-encoder only scores the prefilter_k candidates it returns:
+    prefilter is "bm25" or a function (query, k) -> indices of the knowledge base nodes
+    (e.g. Embedder_BGE_m3.retrieve_indices).
     """
     def __init__(self,
                  knowledge_base,
                  model_path="BAAI/bge-reranker-v2-m3",
                  name='BGE',
-                 top_k=TOP_K):
-        
-        from transformers import AutoModelForSequenceClassification, AutoTokenizer
-        import torch
+                 top_k=TOP_K,
+                 batch_size=16,
+                 max_length=512,
+                 prefilter=None,
+                 prefilter_k=100):
 
         self.name = name
         self.top_k = top_k
         self.knowledge_base = knowledge_base.nodes
+        self.nodes = [TextNode(text=node.text.strip(), metadata=node.metadata) for node in self.knowledge_base]
+        self.texts = [node.text for node in self.knowledge_base]
         self.model_path = model_path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.prefilter_k = prefilter_k
+        self.prefilter = prefilter
+        self.bm25 = BM25Index(self.texts) if prefilter == "bm25" else None
         self.retriever = self.set_retriever()
         self.tokenizer = self.set_tokenizer()
 
     def set_tokenizer(self):
+        from transformers import AutoTokenizer
         tokenizer = AutoTokenizer.from_pretrained(self.model_path)
         return tokenizer
 
     def set_retriever(self):
         if self.name == 'BGE':
+            from transformers import AutoModelForSequenceClassification
             retriever = AutoModelForSequenceClassification.from_pretrained(self.model_path)
             retriever.eval()
         else:
@@ -135,23 +182,40 @@ class Retriever_BGE_v2_m3:
             retriever = None
         return retriever
 
-    def retrieve(self, query: str):
+    def candidates(self, query: str) -> np.ndarray:
         """
-        TODO
+        Indices of the nodes to be scored by the cross-encoder
         """
-        text_metadata_dict = {node.dict()['text']:node.dict()['metadata'] for node in self.knowledge_base}
-        corpus = list(text_metadata_dict.keys())
-        pairs = [[query, k] for k in text_metadata_dict.keys()]
-        # scores = {k:self.retriever.compute_score([query, k])[0] for k in text_metadata_dict.keys()}
-
-        with torch.no_grad():
-            inputs = self.tokenizer(pairs, padding=True, truncation=True, return_tensors='pt', max_length=512)
-            scores = self.retriever(**inputs, return_dict=True).logits.view(-1, ).float()
+        if self.prefilter is None:
+            return np.arange(len(self.nodes))
+        if self.bm25 is not None:
+            return _top_k_indices(self.bm25.get_scores(query), self.prefilter_k)
+        return np.asarray(self.prefilter(query, self.prefilter_k), dtype=np.int64)
 
-        scores_dict = dict(zip(text_metadata_dict.keys(), scores.tolist()))
-        sorted_values = sorted(scores_dict.values(), reverse=True)
-        retrieved_docs = [next((k for k, v in scores_dict.items() if v == value), None) for value in sorted_values[:self.top_k]]
-        return [TextNode(text = retrieved_doc.strip(), metadata = text_metadata_dict[retrieved_doc]) for retrieved_doc in retrieved_docs]
+    def score(self, query: str, indices: np.ndarray) -> np.ndarray:
+        """
+        Cross-encoder scores of (query, node) for the given node indices
+        """
+        scores = np.empty(len(indices), dtype=np.float32)
+        # length buckets: each batch pads to similar lengths
+        order = sorted(range(len(indices)), key=lambda i: len(self.texts[indices[i]]))
+        with torch.inference_mode():
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                pairs = [[query, self.texts[indices[i]]] for i in batch]
+                inputs = self.tokenizer(pairs, padding=True, truncation=True, return_tensors='pt', max_length=self.max_length)
+                logits = self.retriever(**inputs, return_dict=True).logits.view(-1, ).float()
+                scores[batch] = logits.cpu().numpy()
+        return scores
+
+    def retrieve(self, query: str, top_k: int = None):
+        """
+        Retrieve the top n chunks by cross-encoder score
+        """
+        top_k = self.top_k if top_k is None else top_k
+        indices = self.candidates(query)
+        scores = self.score(query, indices)
+        return [self.nodes[indices[i]] for i in _top_k_indices(scores, top_k)]
 
     def set_top_k(self, top_k):
         """
@@ -162,50 +226,66 @@ class Retriever_BGE_v2_m3:
 class Embedder_BGE_m3:
     """
     BAAI/bge-m3
+
+    The knowledge base is encoded once, in batches, into a normalized float32 matrix;
+    a query is encoded once and scored with a single matrix-vector product.
     """
     def __init__(self,
                  knowledge_base,
                  url=BASE_URL,
                  name='bge-m3',
-                 top_k=TOP_K):
+                 top_k=TOP_K,
+                 batch_size=32):
         
         
 
         self.name = name
         self.top_k = top_k
         self.knowledge_base = knowledge_base.nodes
+        self.nodes = [TextNode(text=node.text.strip(), metadata=node.metadata) for node in self.knowledge_base]
         self.url = url
+        self.batch_size = batch_size
+        self.model_id = None
         self.model = self.set_model()
+        self.embeddings = self.encode([node.text for node in self.knowledge_base]) if self.model is not None else None
 
     def set_model(self):
         if self.name == 'bge-m3':
             from sentence_transformers import SentenceTransformer
-            model = SentenceTransformer("BAAI/bge-m3")
+            self.model_id = "BAAI/bge-m3"
+            model = SentenceTransformer(self.model_id)
         else:
             print("RetrieverModule Error: Select a valid retriever.")
             model = None
         return model
 
-    def retrieve(self, query: str):
+    def encode(self, texts: List[str]) -> np.ndarray:
         """
-        TODO
+        Normalized float32 embeddings of the texts, shape (N, D)
+        """
+        # only texts missing from the embedding cache (keyed by the loaded model) go through the model
+        vectors = embed_with_cache(self.model_id, texts,
+                                   lambda missing: self.model.encode(missing, batch_size=self.batch_size, convert_to_numpy=True,
+                                                                     normalize_embeddings=True, show_progress_bar=False))
+        if not vectors:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.ascontiguousarray(np.stack(vectors), dtype=np.float32)
+
+    def retrieve_indices(self, query: str, top_k: int = None) -> np.ndarray:
+        """
+        Indices of the top n nodes by cosine similarity (usable as Retriever_BGE_v2_m3 prefilter)
+        """
+        top_k = self.top_k if top_k is None else top_k
+        if len(self.nodes) == 0:
+            return np.empty(0, dtype=np.int64)
+        scores = self.embeddings @ self.encode([query])[0]
+        return _top_k_indices(scores, top_k)
+
+    def retrieve(self, query: str, top_k: int = None):
+        """
+        Retrieve the top n chunks by cosine similarity
         """
-        text_metadata_dict = {node.dict()['text']:node.dict()['metadata'] for node in self.knowledge_base}
-        corpus = list(text_metadata_dict.keys())
-        pairs = [[query, k] for k in text_metadata_dict.keys()]
-        # scores = {k:self.retriever.compute_score([query, k])[0] for k in text_metadata_dict.keys()}
-
-        scores = []
-        for sent1, sent2 in pairs:
-            emb1 = self.model.encode(sent1, convert_to_tensor=True, normalize_embeddings=False)
-            emb2 = self.model.encode(sent2, convert_to_tensor=True, normalize_embeddings=False)
-            dot_sim = torch.dot(emb1, emb2).item()
-            scores.append(dot_sim)
-
-        scores_dict = dict(zip(text_metadata_dict.keys(), scores))
-        sorted_values = sorted(scores_dict.values(), reverse=True)
-        retrieved_docs = [next((k for k, v in scores_dict.items() if v == value), None) for value in sorted_values[:self.top_k]]
-        return [TextNode(text = retrieved_doc.strip(), metadata = text_metadata_dict[retrieved_doc]) for retrieved_doc in retrieved_docs]
+        return [self.nodes[i] for i in self.retrieve_indices(query, top_k)]
 
     def set_top_k(self, top_k):
         """
@@ -213,61 +293,105 @@ class Embedder_BGE_m3:
         """
         self.top_k = top_k
 
+class _RateLimiter:
+    """
+    Spaces the starts of the requests so that at most `rate` start per second (thread-safe)
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
 class Embedder_BGE_m3_kubeai:
 
     """
-    BAAI/bge-m3
+    BAAI/bge-m3 served by an OpenAI-compatible endpoint (KubeAI)
+
+    Chunks are embedded with batched requests (`input=[...]`), sent concurrently
+    (at most max_concurrency in flight, at most requests_per_second started per second),
+    and kept in the embedding cache, so each chunk is embedded once; the query is embedded
+    once per retrieval.
     """
     def __init__(self,
                  knowledge_base,
                  url="",
                  name='bge-m3',
-                 top_k=TOP_K):
+                 top_k=TOP_K,
+                 batch_size=64,
+                 max_concurrency=4,
+                 requests_per_second=None):
 
         self.name = name
         self.top_k = top_k
         self.knowledge_base = knowledge_base.nodes
+        self.nodes = [TextNode(text=node.text.strip(), metadata=node.metadata) for node in self.knowledge_base]
+        self.texts = [node.text for node in self.knowledge_base]
         self.url = url
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = _RateLimiter(requests_per_second)
         self.client = self.set_model()
+        self.embeddings = None
 
     def set_model(self):
-        from start_api import start_api_openai_key, start_api_openai_base_url
+        from aixparag.clients import get_openai_client, get_settings
         if self.name == 'bge-m3':
-            client = OpenAI(api_key=start_api_openai_key, base_url=start_api_openai_base_url) 
+            # a specific endpoint if url is given, the shared client otherwise
+            client = OpenAI(base_url=self.url, api_key=get_settings().api_key) if self.url else get_openai_client()
         else:
             print("RetrieverModule Error: Select a valid retriever.")
             client = None
         return client
 
-    def retrieve(self, query: str):
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        self.rate_limiter.wait()
+        response = self.client.embeddings.create(input=texts, model=self.name)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
         """
-        TODO
+        Embeddings of the texts, shape (N, D): cached ones are reused, the others
+        are requested in concurrent batches
+        """
+        def embed_missing(missing):
+            batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+                return [vector for batch_vectors in pool.map(self._embed_batch, batches) for vector in batch_vectors]
+
+        vectors = embed_with_cache("kubeai/" + self.name, texts, embed_missing)
+        return np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def retrieve_indices(self, query: str, top_k: int = None) -> np.ndarray:
+        """
+        Indices of the top n nodes by dot product with the query
         """
-        text_metadata_dict = {node.dict()['text']:node.dict()['metadata'] for node in self.knowledge_base}
-        corpus = list(text_metadata_dict.keys())
-        pairs = [[query, k] for k in text_metadata_dict.keys()]
-        # scores = {k:self.retriever.compute_score([query, k])[0] for k in text_metadata_dict.keys()}
-
-        embeddings = np.array([
-        [
-            self.client.embeddings.create(input=chunk, model="bge-m3").data[0].embedding,
-            self.client.embeddings.create(input=query, model="bge-m3").data[0].embedding
-        ]
-        for chunk, query in pairs
-        ])
-
-        # Separate chunk and query embeddings
-        chunk_embeddings = np.stack(embeddings[:, 0])  # Shape: (N, D)
-        query_embeddings = np.stack(embeddings[:, 1])  # Shape: (N, D)
-        scores = np.einsum('ij,ij->i', chunk_embeddings, query_embeddings)  # Shape: (N,)
-
-        scores_dict = dict(zip(text_metadata_dict.keys(), scores.tolist()))
-        sorted_values = sorted(scores_dict.values(), reverse=True)
-        retrieved_docs = [next((k for k, v in scores_dict.items() if v == value), None) for value in sorted_values[:self.top_k]]
-        return [TextNode(text = retrieved_doc.strip(), metadata = text_metadata_dict[retrieved_doc]) for retrieved_doc in retrieved_docs]
+        top_k = self.top_k if top_k is None else top_k
+        if len(self.texts) == 0:
+            return np.empty(0, dtype=np.int64)
+        if self.embeddings is None:
+            self.embeddings = self.embed(self.texts)
+        scores = self.embeddings @ self.embed([query])[0]
+        return _top_k_indices(scores, top_k)
+
+    def retrieve(self, query: str, top_k: int = None):
+        """
+        Retrieve the top n chunks by dot product with the query
+        """
+        return [self.nodes[i] for i in self.retrieve_indices(query, top_k)]
 
     def set_top_k(self, top_k):
         """
         TODO
         """
-        self.top_k = top_k
\ No newline at end of file
+        self.top_k = top_k
@@ -1,24 +1,212 @@
+import re
+import unicodedata
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def normalize(text):
+    # offsets are computed on this form (lowercase, "\n" line endings)
+    return text.lower().replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _find(document, text):
+    # document and text already normalized; an empty text matches at 0 of a non-empty document
+    if not document:
+        return (None, None)
+    index_start = document.find(text)
+    if index_start < 0:
+        return (None, None)
+    return (index_start, index_start + len(text))
+
+
 def find_indexes(document, text):
 
-    document = document.lower()
-    text = text.lower()
-    document = document.replace('\r\n', '\n').replace('\r', '\n')
-    text = text.replace('\r\n', '\n').replace('\r', '\n')
-    
-    index_start, index_end = None, None
+    return _find(normalize(document), normalize(text))
+
+
+# Cyrillic letters that show up in place of Latin ones in the converted plans
+_CONFUSABLES = {"а": "a", "е": "e", "о": "o", "р": "p", "с": "c", "х": "x",
+                "у": "y", "і": "i", "ј": "j", "ѕ": "s", "к": "k", "м": "m", "т": "t", "н": "h"}
+
+
+class _FoldTable(dict):
+    """
+    str.translate table folding accents and confusable letters, filled lazily.
+    Every character maps to exactly one character, so offsets are preserved.
+    """
+
+    def __missing__(self, code):
+        char = chr(code)
+        base = "".join(c for c in unicodedata.normalize("NFKD", char) if not unicodedata.combining(c))
+        base = _CONFUSABLES.get(base, base)
+        self[code] = base if len(base) == 1 else char
+        return self[code]
+
+
+_FOLD_TABLE = _FoldTable()
+_TOKEN_RE = re.compile(r"\w+")
+# token ids are hashed into 20 bits, so that three of them pack into one int64 n-gram code
+_ID_BITS = 20
+_ID_MASK = (1 << _ID_BITS) - 1
+# n-grams occurring more often than this in a document are not used as anchors
+_MAX_ANCHOR_HITS = 32
+
+
+def _tokens(normalized_text):
+    folded = normalized_text.translate(_FOLD_TABLE)
+    ids, starts, ends = [], [], []
+    for match in _TOKEN_RE.finditer(folded):
+        ids.append(hash(match.group()) & _ID_MASK)
+        starts.append(match.start())
+        ends.append(match.end())
+    return (np.array(ids, dtype=np.int64), np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+
+
+def _ngram_codes(ids, n):
+    if len(ids) < n:
+        return np.empty(0, dtype=np.int64)
+    codes = ids[:len(ids) - n + 1].copy()
+    for k in range(1, n):
+        codes = (codes << _ID_BITS) | ids[k:len(ids) - n + 1 + k]
+    return codes
+
+
+@lru_cache(maxsize=32)
+def _document_index(normalized_document, n):
+    # token ids and offsets, plus the sorted n-gram codes used to seed the alignment;
+    # cached, as the same plans are grounded request after request
+    ids, starts, ends = _tokens(normalized_document)
+    codes = _ngram_codes(ids, n)
+    order = np.argsort(codes, kind="stable")
+    return ids, starts, ends, codes[order], order
+
+
+def _seed_diagonal(chunk_ids, doc_codes_sorted, doc_order, n, band):
+    """
+    Most voted diagonal (document token - chunk token) among the exact n-gram anchors.
+    """
+    chunk_codes = _ngram_codes(chunk_ids, n)
+    lo = np.searchsorted(doc_codes_sorted, chunk_codes, side="left")
+    hi = np.searchsorted(doc_codes_sorted, chunk_codes, side="right")
+    counts = hi - lo
+    keep = (counts > 0) & (counts <= _MAX_ANCHOR_HITS)
+    if not keep.any():
+        return None
+    lo, counts = lo[keep], counts[keep]
+    chunk_pos = np.repeat(np.nonzero(keep)[0], counts)
+    # positions lo[i], lo[i]+1, ..., hi[i]-1 of every kept n-gram
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    doc_pos = doc_order[np.repeat(lo, counts) + offsets]
+    diagonals = doc_pos - chunk_pos
+    bins = diagonals // band
+    values, inverse, votes = np.unique(bins, return_inverse=True, return_counts=True)
+    best = np.argmax(votes)
+    return int(np.median(diagonals[inverse.ravel() == best]))
+
+
+def _align(chunk_ids, doc_ids):
+    """
+    Semi-global edit distance of the chunk tokens against a window of document tokens
+    (the chunk must be aligned entirely, the document can start and end anywhere).
+    Each DP row is computed with numpy: the horizontal gaps are a cumulative minimum.
+
+    Returns:
+        (distance, start, end): the best cost and the aligned window tokens [start, end).
+    """
+    width = len(doc_ids) + 1
+    columns = np.arange(width, dtype=np.int64)
+    cost = np.zeros(width, dtype=np.int64)
+    origin = columns.copy()
+    for token in chunk_ids:
+        substitution = cost[:-1] + (doc_ids != token)
+        new_cost = cost + 1
+        new_origin = origin.copy()
+        take = substitution <= new_cost[1:]
+        new_cost[1:] = np.where(take, substitution, new_cost[1:])
+        new_origin[1:] = np.where(take, origin[:-1], new_origin[1:])
+        # cost[j] = min over k <= j of new_cost[k] + (j - k), carrying the origin of the minimum
+        key = np.minimum.accumulate((new_cost - columns) * width + new_origin)
+        cost = key // width + columns
+        origin = key % width
+    end = int(np.argmin(cost[1:])) + 1
+    return int(cost[end]), int(origin[end]), end
+
+
+class SpanFinder:
+    """
+    Locates chunks of text in a list of documents.
+
+    Each document is normalized once (on first use) instead of once per chunk, and
+    every lookup is a single str.find, which is linear in the document length.
+    Offsets are the same returned by find_indexes.
+    """
+
+    def __init__(self, documents_list: List[str]):
+        self.documents_list = documents_list
+        self._normalized: List[Optional[str]] = [None] * len(documents_list)
+
+    def document(self, i: int) -> str:
+        if self._normalized[i] is None:
+            self._normalized[i] = normalize(self.documents_list[i])
+        return self._normalized[i]
+
+    def find_indexes(self, i: int, text: str) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Offsets of the first occurrence of ``text`` in the i-th document, or (None, None).
+        """
+        return _find(self.document(i), normalize(text))
+
+    def find_all(self, text: str) -> List[Tuple[int, int, int]]:
+        """
+        (document index, offset_start, offset_end) of ``text`` in every document containing it.
+        """
+        text = normalize(text)
+        found = []
+        for i in range(len(self.documents_list)):
+            index_start, index_end = _find(self.document(i), text)
+            if index_start is not None:
+                found.append((i, index_start, index_end))
+        return found
+
+    def find_fuzzy(self, text: str, min_score: float = 0.6, n: int = 3) -> Optional[Tuple[int, int, int, float]]:
+        """
+        Approximate location of ``text``, for chunks that differ from the document by
+        whitespace, accents or encoding artifacts (e.g. "potrа" for "potrà").
 
-    # text_long_list = []
-    # for letter in document:
-    #     text_long_list.append(letter)
+        Tokens are compared after folding accents and confusable letters; exact
+        n-gram anchors select a diagonal in each document and the chunk is then
+        aligned (token edit distance) against the document window around it.
 
+        Args:
+            text (str): The chunk to locate.
+            min_score (float): Minimum confidence, 1 - edit distance / number of chunk tokens.
+            n (int): Length of the n-gram anchors.
 
-    for i in range(len(document)):
-        if document[i:i+len(text)] == text:
-            index_start = i
-            index_end = i+len(text)
-            break
-    
-            
-    return(index_start,index_end)
+        Returns:
+            (document index, offset_start, offset_end, score) of the best alignment, or None.
+        """
+        chunk_ids = _tokens(normalize(text))[0]
+        if len(chunk_ids) == 0:
+            return None
+        n = min(n, len(chunk_ids))
+        band = max(8, len(chunk_ids) // 10)
 
-#
\ No newline at end of file
+        best = None
+        for i in range(len(self.documents_list)):
+            doc_ids, starts, ends, codes_sorted, order = _document_index(self.document(i), n)
+            diagonal = _seed_diagonal(chunk_ids, codes_sorted, order, n, band)
+            if diagonal is None:
+                continue
+            window_start = max(0, diagonal - band)
+            window_end = min(len(doc_ids), diagonal + len(chunk_ids) + band)
+            distance, start, end = _align(chunk_ids, doc_ids[window_start:window_end])
+            if end <= start:
+                continue
+            score = max(0.0, 1.0 - distance / len(chunk_ids))
+            if best is None or score > best[3]:
+                best = (i, int(starts[window_start + start]), int(ends[window_start + end - 1]), score)
+        if best is None or best[3] < min_score:
+            return None
+        return best